@@ -1,6 +1,6 @@
 import logging
 from enum import Enum
-from typing import Dict, Tuple, Union
+from typing import Dict, Optional, Tuple, Union
 
 import torch
 import torch.nn as nn
@@ -71,24 +71,56 @@ class ContinuousDiffusionProcess(nn.Module):
             ),
             requires_grad=False,
         )
+        # The drift is linear in the state and the diffusion only depends on time, so the Euler steps of the forward
+        # equation can be unrolled in closed form (see forward_sample) when their multiplicative factors are positive.
+        self._unrolled_forward_sample: bool = (
+            self.sde_type is SDEType.VE
+            or 0.5 * float(self.coefficients["beta_1"]) / self.num_diffusion_steps < 1.0
+        )
         return
 
-    def forward_sample(self, x: torch.Tensor) -> torch.Tensor:
+    def forward_sample(
+        self, x: torch.Tensor, out: Optional[torch.Tensor] = None
+    ) -> torch.Tensor:
         """
         Generate forward samples using the SDE.
 
         Args:
             data (torch.Tensor): The input data.
+            out (torch.Tensor, optional): Tensor of shape (S, N, L, D) where the trajectory is written. Allocated if None.
 
         Returns:
             torch.Tensor: The progressively noisier data of shape (S, N, L, D).
         """
-        trajectory = [x]
-
-        for time_step in self.linspace_diffusion_steps:
-            x = self._forward_one_step(x, time_step)
-            trajectory.append(x)
-        return torch.stack(trajectory, dim=0)
+        num_steps = self.linspace_diffusion_steps.shape[0]
+        if out is None:
+            out = x.new_empty((num_steps + 1, *x.shape))
+        assert out.shape == (
+            num_steps + 1,
+            *x.shape,
+        ), f"Expected out of shape {(num_steps + 1, *x.shape)}, but got {out.shape}."
+        out[0] = x
+
+        if not self._unrolled_forward_sample:
+            for i, time_step in enumerate(self.linspace_diffusion_steps, start=1):
+                x = self._forward_one_step(x, time_step)
+                out[i] = x
+            return out
+
+        # The Euler steps of _forward_one_step are x_i = a_i x_{i-1} + b_i eps_i, with a_i = 1 + f(t_i) dt and
+        # b_i = g(t_i) sqrt(dt) depending only on time. Unrolled, x_i = A_i (x_0 + sum_{j <= i} b_j / A_j eps_j)
+        # with A_i = a_1 ... a_i. This is the same path as the loop, in a few kernels instead of several per step.
+        times = self.linspace_diffusion_steps - 1
+        drift, diffusion = self._compute_drift_and_diffusion(
+            torch.ones(times.shape, device=x.device, dtype=x.dtype), times
+        )
+        shape_coefficients = (-1,) + (1,) * x.dim()
+        cumprod_a = torch.cumprod(1.0 + drift * self.dt, 0).view(shape_coefficients)
+        b = (diffusion * torch.sqrt(self.dt)).view(shape_coefficients)
+        noise = torch.randn(out[1:].shape, device=x.device, dtype=x.dtype)
+        torch.cumsum(b / cumprod_a * noise, 0, out=out[1:])
+        out[1:].add_(x).mul_(cumprod_a)
+        return out
 
     def backward_sample(
         self,
@@ -97,6 +129,8 @@ class ContinuousDiffusionProcess(nn.Module):
         *,
         proba_teacher_forcing: float = 0.0,
         sequences_forcing: torch.Tensor = None,
+        reverse: bool = False,
+        time_steps: Optional[torch.Tensor] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """
         Sample from the diffusion process using the backward SDE.
@@ -106,6 +140,9 @@ class ContinuousDiffusionProcess(nn.Module):
             model (nn.Module): The model to predict the score. Called with two arguments: the data and the timestep.
             proba_teacher_forcing (float): Probability of using teacher forcing during sampling. Must be between 0 and 1.
             sequences_forcing (torch.Tensor, optional): The sequences to use if teacher forcing is applied. Should match the batch size of noise.
+            reverse (bool): If True, the trajectory is ordered from the denoised data to the noise, so the first value is the final sample.
+            time_steps (torch.Tensor, optional): Decreasing time steps (indices) where each backward step starts, the last one ending at 0.
+                A step from t to the next time step t' has a dt of (t - t') / total_steps. Defaults to all the time steps, from total_steps to 1.
 
         Returns:
             Tuple[torch.Tensor, torch.Tensor]: The final sample and the trajectory.
@@ -123,18 +160,35 @@ class ContinuousDiffusionProcess(nn.Module):
             proba_teacher_forcing < 1e-6 or sequences_forcing is not None
         ), "Teacher forcing requires sequences_forcing when probability is non-zero"
 
+        if time_steps is None:
+            time_steps = reversed(self.linspace_diffusion_steps)
+            # All the steps have the default dt.
+            dts = None
+        else:
+            assert (
+                time_steps.dim() == 1
+            ), f"Expected time_steps of shape (num_steps,), but got {time_steps.shape}."
+            dts = (
+                time_steps - torch.cat((time_steps[1:], time_steps.new_zeros(1)))
+            ) * self.dt
+
         x_t = noise
-        denoised_data = [x_t]
+        # Written in place in the requested order, which avoids stacking and flipping the trajectory afterwards.
+        num_steps = time_steps.shape[0]
+        denoised_data = noise.new_empty((num_steps + 1, *noise.shape))
+        denoised_data[num_steps if reverse else 0] = x_t
         use_teacher_forcing = torch.rand(1).item() < proba_teacher_forcing
 
-        for time_step in reversed(self.linspace_diffusion_steps):
+        for i, time_step in enumerate(time_steps, start=1):
             if use_teacher_forcing:
                 # We need to shift by 1 because the time step is shifted due to fixing first value to noise.
                 x_t = sequences_forcing[time_step - 1]
             pred_score = model(x_t, time_step)
-            x_t = self._backward_one_step(x_t, time_step, pred_score)
-            denoised_data.append(x_t)
-        return torch.stack(denoised_data, dim=0)
+            x_t = self._backward_one_step(
+                x_t, time_step, pred_score, dt=None if dts is None else dts[i - 1]
+            )
+            denoised_data[num_steps - i if reverse else i] = x_t
+        return denoised_data
 
     def _forward_one_step(self, x_prev: torch.Tensor, t: int) -> torch.Tensor:
         """
@@ -159,6 +213,7 @@ class ContinuousDiffusionProcess(nn.Module):
         t: int,
         pred_score: torch.Tensor,
         clip_denoised: bool = True,
+        dt: Optional[torch.Tensor] = None,
     ) -> torch.Tensor:
         """
         Perform one backward step of the SDE.
@@ -168,16 +223,19 @@ class ContinuousDiffusionProcess(nn.Module):
             t (torch.Tensor): The current timestep (index) as a tensor of shape (1,).
             pred_score (torch.Tensor): The predicted score from the model.
             clip_denoised (bool): Whether to clip the denoised output.
+            dt (torch.Tensor, optional): The length of the step. Defaults to the length of one time step.
 
         Returns:
             torch.Tensor: The state at the previous timestep.
         """
+        if dt is None:
+            dt = self.dt
         drift, diffusion = self._compute_drift_and_diffusion(x_t, t)
         noise = torch.randn_like(x_t, device=x_t.device)
         x_prev = (
             x_t
-            - (drift - diffusion * diffusion * pred_score) * self.dt
-            + diffusion * noise * torch.sqrt(self.dt)
+            - (drift - diffusion * diffusion * pred_score) * dt
+            + diffusion * noise * torch.sqrt(dt)
         )
 
         if clip_denoised and x_t.ndim > 2:
@@ -32,6 +32,9 @@ def histogram_torch(x, bins, density=True):
 
 class HistogramLoss(nn.Module):
     # nn.Module because it has a parameter to register.
+    # Upper bound on the number of sample-to-bin comparisons materialised at once by compute.
+    MAX_COMPARISONS_PER_CHUNK = 2**24
+
     def __init__(self, x_real: torch.Tensor, n_bins: int):
         """
         Initializes the HistogramLoss with the real data distribution.
@@ -128,26 +131,24 @@ class HistogramLoss(nn.Module):
             x_fake.shape[1] == self.num_time_steps
         ), f"Expected {self.num_time_steps} time steps in x_fake, but got {x_fake.shape[1]}."
 
-        all_losses: typing.List = []
-
-        for time_step in range(x_fake.shape[1]):
-            per_time_losses: typing.List = []
-            for feature_idx in range(x_fake.shape[2]):
-                # Localisation of the bins
-                loc: torch.Tensor = self.center_bin_locs[time_step][feature_idx]
-                # Fake samples at time step t for feature i
-                x_ti: torch.Tensor = x_fake[:, time_step, feature_idx].reshape(-1, 1)
-                # Distance bin center to the sample.
-                dist: torch.Tensor = torch.abs(x_ti - loc)
-                # Counts how many element of the fake data falls within the corresponding bins of the real data.
-                counter: torch.Tensor = ((self.bin_widths[time_step][feature_idx] / 2.0 - dist) > 0.0).float()
-                # Normalized count of fake data points within each bin
-                density: torch.Tensor = counter.mean(0) / self.bin_widths[time_step][feature_idx]
-                # Abs difference between the density of the fake data and the density of the real data for each bin
-                abs_metric: torch.Tensor = torch.abs(density - self.densities[time_step][feature_idx])
-                per_time_losses.append(torch.mean(abs_metric))
-            all_losses.append(torch.stack(per_time_losses))
-        all_losses: torch.Tensor = torch.stack(all_losses)
+        # All time steps and features at once, the bins per time and feature are stacked to shape (L, D, n_bins).
+        locs: torch.Tensor = torch.stack(tuple(self.center_bin_locs))
+        bin_widths: torch.Tensor = torch.stack(tuple(self.bin_widths)).unsqueeze(-1)
+        densities_real: torch.Tensor = torch.stack(tuple(self.densities))
+        # The samples are compared by chunks, so the comparisons of shape (chunk, L, D, n_bins) stay bounded in memory
+        # whatever the number of samples.
+        chunk_size: int = max(self.MAX_COMPARISONS_PER_CHUNK // locs.numel(), 1)
+        counts: torch.Tensor = torch.zeros_like(locs)
+        for x_fake_chunk in x_fake.split(chunk_size):
+            # Distance bin center to the sample, shape (chunk, L, D, n_bins).
+            dist: torch.Tensor = torch.abs(x_fake_chunk.unsqueeze(-1) - locs)
+            # Counts how many element of the fake data falls within the corresponding bins of the real data.
+            counts += ((bin_widths / 2.0 - dist) > 0.0).sum(0)
+        # Normalized count of fake data points within each bin
+        density: torch.Tensor = counts / (x_fake.shape[0] * bin_widths)
+        # Abs difference between the density of the fake data and the density of the real data for each bin
+        abs_metric: torch.Tensor = torch.abs(density - densities_real)
+        all_losses: torch.Tensor = abs_metric.mean(-1)
         return all_losses
 
     def forward(self, x_fake, ignore_features: list = None):
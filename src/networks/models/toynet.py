@@ -50,13 +50,19 @@ class ToyNet(nn.Module):
         return
 
     def forward(self, x: torch.Tensor, t: torch.Tensor) -> torch.Tensor:
-        # Be careful, t needs to be a scalar (0D or 1D in torch).
-        t_emb = self.trigotime_embed(t.view(1))
+        # Be careful, t needs to be either a scalar (0D or 1D in torch) shared by the whole batch,
+        # or of shape (N,) with one time per element of the batch.
+        t_emb = self.trigotime_embed(t.view(-1, 1))
         t_out = self.time_fcnn(t_emb)
         x_out = self.data_resnet(x)
         out = self.out_fcnn(
             torch.cat(
-                [x_out, t_out.view(1, 1, -1).expand(x_out.size(0), x_out.size(1), -1)],
+                [
+                    x_out,
+                    t_out.view(-1, 1, t_out.size(-1)).expand(
+                        x_out.size(0), x_out.size(1), -1
+                    ),
+                ],
                 dim=-1,
             )
         )
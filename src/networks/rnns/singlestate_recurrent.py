@@ -18,9 +18,11 @@ class SingleStateRecurrent(nn.Module):
             requires_grad=True,
         )  # parameters are moved to device and learnt.
 
-    def get_hidden_states(self, batch_size):
-        return self.hidden_state_0.repeat(batch_size)
+    def get_hidden_states(self, batch_size: int):
+        # expand is a view over the batch dimension and the gradient still flows to the parameter.
+        # The recurrent layers (cuDNN) consuming the hidden states need them contiguous, hence the single copy.
+        return self.hidden_state_0.expand(-1, batch_size, -1).contiguous()
 
     def forward(self, x):
-        batch_size = (1, x.shape[0], 1)
+        batch_size = x.shape[0]
         return (x, self.get_hidden_states(batch_size))
@@ -1,3 +1,4 @@
+import contextlib
 import logging
 import math
 import typing
@@ -7,9 +8,13 @@ import numpy as np
 import seaborn as sns
 import torch
 import torch.nn as nn
+from cycler import cycler
+from matplotlib.collections import LineCollection
+from torch.nn.parallel import DistributedDataParallel
 
 from src.metrics.epdf import HistogramLoss
 from src.trainers.trainer import Trainer
+from src.utils.utils import make_adam, to_host_non_blocking
 from src.utils.utils_os import savefig
 
 logger = logging.getLogger(__name__)
@@ -26,9 +31,16 @@ from src.differentialequations.diffusionprocess_continuous import (
 # TODO 12/08/2024 nie_k: Alternative plot for swiss roll.
 
 PERIOD_PLOT_VAL = 100
-sns.set()
+# The training histogram loss is only reported, so it is computed one generator step out of PERIOD_TRAIN_EPDF.
+PERIOD_TRAIN_EPDF = 50
+# The seaborn theme of the trajectory plots, only applied to them rather than to the matplotlib state of the process.
+_SEABORN_THEME_RC = {
+    **sns.axes_style("darkgrid"),
+    **sns.plotting_context("notebook"),
+    "axes.prop_cycle": cycler(color=sns.color_palette("deep")),
+    "font.family": "sans-serif",
+}
 
-PLOT_DIFFUSION_FIG, PLOT_DIFFUSION_AXES = plt.subplots(1, 2, sharey=True)
 NUM_STEPS_DIFFUSION_2_CONSIDER = 8
 # Adding 1 for the zero at the beginning.
 NUM_STEPS_DIFFUSION_2_CONSIDER += 1
@@ -40,40 +52,42 @@ class DiffPCFGANTrainer(Trainer):
     def get_noise_vector(shape: typing.Tuple[int, ...], device: str) -> torch.Tensor:
         return torch.randn(*shape, device=device)
 
-    @staticmethod
-    def _flat_add_time_transpose_and_add_zero(data: torch.Tensor) -> torch.Tensor:
+    def _flat_add_time_transpose_and_add_zero(
+        self, data: torch.Tensor, max_steps: typing.Optional[int] = None
+    ) -> torch.Tensor:
         # Receive data of shape (S, N, L, D).
-        # Transforms it into (N, S, L * D)
+        # Transforms it into (N, S + 1, L * D + 1)
+        # If max_steps is given, only the first max_steps - 1 diffusion steps are considered and the output
+        # is of shape (N, max_steps, L * D + 1), the zero at the beginning included.
+        if max_steps is not None:
+            assert (
+                max_steps >= 1
+            ), f"max_steps should be at least 1 but got {max_steps}."
+            data = data[: max_steps - 1]
+        S, N, L, D = data.shape
+        assert (
+            S + 1 <= self._diffusion_times.shape[0]
+        ), f"Expected at most {self._diffusion_times.shape[0] - 1} diffusion steps but got {S}."
 
-        # Merge the sequence dimension (dim 2) and the feature dimension (dim 3) into a single dimension.
-        # Flattening is required before adding time otherwise we would add too many dimensions with the time.
-        data = data.flatten(2, 3)
+        # The output is allocated once, directly in its final layout, and filled in place.
+        # Concatenating the zeros and the times would allocate and copy the whole data twice.
+        out = torch.empty((N, S + 1, L * D + 1), device=data.device, dtype=data.dtype)
 
         # Add a zero at the beginning of the sequence. By adding it before time simplifies time augmentation.
-        # WIP MOVE THIS
-        zeros = torch.zeros(1, data.shape[1], data.shape[2], device=data.device)
-        data = torch.cat((zeros, data), dim=0)
-
-        # Add the times to the data by creating a linspace between 0,1 and which is repeated for all (N,L).
-        diffusion_times = (
-            torch.linspace(
-                0.0,
-                1.0,
-                steps=data.shape[0],
-                device=data.device,
-            )
-            .view(-1, 1, 1)
-            .expand(
-                data.shape[0],
-                data.shape[1],
-                1,
-            )
-        )
-        data = torch.cat((data, diffusion_times), dim=-1)
-        # Permute the batch axis and the diffusion axis.
-        data = data.transpose(0, 1)
-        # adding contiguous slows down the code tremendously, so we keep it like that.
-        return data
+        out[:, 0, : L * D] = 0.0
+        # Merge the sequence dimension (dim 2) and the feature dimension (dim 3) into a single dimension
+        # and permute the batch axis and the diffusion axis.
+        out[:, 1:, : L * D] = data.flatten(2, 3).transpose(0, 1)
+        # Add the times to the data with the cached linspace between 0,1 which is broadcast for all N.
+        out[:, :, L * D] = self._diffusion_times[: S + 1]
+        return out
+
+    @staticmethod
+    def _reconstruction_view(data: torch.Tensor) -> torch.Tensor:
+        # Receive data of shape (S, N, L, D).
+        # Returns the first diffusion step flattened, of shape (N, L * D). It is equal to
+        # _flat_add_time_transpose_and_add_zero(data)[:, 1, :-1] without building the whole transformed trajectory.
+        return data[0].flatten(1, 2)
 
     def __init__(
         self,
@@ -94,6 +108,8 @@ class DiffPCFGANTrainer(Trainer):
             test_metrics_train=None,
             test_metrics_test=None,
             feature_dim_time_series=config.input_dim,
+            # On top of PERIOD_PLOT_VAL, which also gates the trajectory plots.
+            plot_every_n_epochs=getattr(config, "plot_every_n_epochs", 10),
         )
 
         # Parameter for pytorch lightning
@@ -105,8 +121,28 @@ class DiffPCFGANTrainer(Trainer):
         self.lr_disc = learning_rate_disc
 
         # Score Network Params
+        # The score network is called at every step of the backward rollout, so compiling it removes most of the
+        # Python and dispatch overhead of the many small kernels. Opt-in: with dynamic=False, every new batch size (e.g.
+        # a smaller last batch, or the validation batches) triggers a recompilation, and with "reduce-overhead" the
+        # recording of new CUDA graphs.
+        self.compile_model = getattr(config, "compile_model", False) and hasattr(
+            torch.nn.Module, "compile"
+        )
+        # "reduce-overhead" uses CUDA graphs, "max-autotune" can be used for benchmarking.
+        self.compile_mode = getattr(config, "compile_mode", "reduce-overhead")
+        if self.compile_model:
+            # Compiled in place, so the module tree and the keys of the state dict are the same with or without
+            # compilation, and checkpoints load either way.
+            score_network.compile(mode=self.compile_mode, dynamic=False)
         self.score_network = score_network
 
+        # Size of the batch of the warm-up, see on_train_start. None to not warm up.
+        self.warmup_max_batch = getattr(config, "warmup_max_batch", None)
+
+        # Mixed precision for the rollouts and the losses, see _autocast. Opt-in, as it changes the numerics of the
+        # generator and of the PCF losses compared to fp32.
+        self.use_bf16_autocast = getattr(config, "use_bf16_autocast", False)
+
         # Discriminator Params
         self.num_samples_pcf = num_samples_pcf
         self.hidden_dim_pcf = hidden_dim_pcf
@@ -116,10 +152,64 @@ class DiffPCFGANTrainer(Trainer):
             # TODO 13/08/2024 nie_k: instead of input_dim, set time_series_for_compar_dim
             input_size=self.config.input_dim * self.config.n_lags + 1,
         )
+        if self.compile_model:
+            # Only distance_measure is called by the trainer, compiling the module would only compile forward.
+            # Only the method is replaced, the parameters and the keys of the state dict stay on the uncompiled module.
+            compiled_distance_measure = torch.compile(
+                self.discriminator.distance_measure,
+                mode=self.compile_mode,
+                dynamic=False,
+            )
+
+            def distance_measure(*args, **kwargs) -> torch.Tensor:
+                # With CUDA graphs ("reduce-overhead"), the outputs of a compiled call may be overwritten by the next
+                # compiled calls, e.g. of the score network in the score matching loss, which run before the distance
+                # is read or logged. It is cloned as soon as it is computed.
+                return compiled_distance_measure(*args, **kwargs).clone()
+
+            self.discriminator.distance_measure = distance_measure
         self.D_steps_per_G_step = num_D_steps_per_G_step
+        # Number of steps of the trajectories (zero included) compared by the discriminator, without the last step.
+        self.num_steps_diffusion_2_consider = min(
+            NUM_STEPS_DIFFUSION_2_CONSIDER, num_diffusion_steps + 1
+        )
         self.use_fixed_measure_discriminator_pcfd = use_fixed_measure_discriminator_pcfd
 
+        # During training, only the last steps of the backward path are compared (the first ones of the trajectory).
+        # The noisier steps before them can be sampled with a stride, which reduces the number of calls to the score
+        # network with coarser steps. The compared steps are always sampled one by one. A stride of 1 samples all the
+        # steps, the validation always samples all of them.
+        self.backward_stride_training = getattr(config, "backward_stride_training", 1)
+        assert (
+            self.backward_stride_training >= 1
+        ), f"backward_stride_training should be at least 1 but got {self.backward_stride_training}."
+        # Time index of the last compared step, the state reached after the strided steps.
+        last_compared_step = self.num_steps_diffusion_2_consider - 2
+        self.register_buffer(
+            "_training_backward_time_steps",
+            (
+                torch.cat(
+                    (
+                        torch.arange(
+                            num_diffusion_steps,
+                            last_compared_step,
+                            -self.backward_stride_training,
+                        ),
+                        torch.arange(last_compared_step, 0, -1),
+                    )
+                )
+                if self.backward_stride_training > 1
+                else None
+            ),
+            persistent=False,
+        )
+
         self.output_dir_images = config.exp_dir
+        # Pinned host buffers receiving the denoised and diffused trajectories to plot, reused across the plots.
+        self._host_buffers_plots: typing.Tuple[typing.Optional[torch.Tensor], ...] = (
+            None,
+            None,
+        )
 
         # Diffusion:
         self.diffusion_process = ContinuousDiffusionProcess(
@@ -128,6 +218,19 @@ class DiffPCFGANTrainer(Trainer):
             sde_type=SDEType.VP,
         )
         self.num_diffusion_steps = num_diffusion_steps
+        # Times added to the trajectories, for the zero at the beginning and the num_diffusion_steps + 1 steps.
+        # Constant, so computed once and moved to the device with the module. Not part of the checkpoints.
+        self.register_buffer(
+            "_diffusion_times",
+            torch.linspace(0.0, 1.0, steps=num_diffusion_steps + 2),
+            persistent=False,
+        )
+        # Cache of the indices of features to diffuse, see _get_indices_where_diffuse.
+        self._indices_where_diffuse: typing.Dict[
+            typing.Tuple, typing.Tuple[torch.Tensor, typing.Optional[torch.Tensor]]
+        ] = {}
+        # Buffer of the forward paths, see _get_forward_path_buffer.
+        self._forward_path_buffer: typing.Optional[torch.Tensor] = None
 
         ### Loses
         self.use_diffusion_score_matching_loss = True
@@ -136,6 +239,9 @@ class DiffPCFGANTrainer(Trainer):
         self.train_histo_loss = HistogramLoss(
             data_train, int(round(2.0 * math.pow(data_train.shape[0], 1.0 / 3.0), 0))
         )
+        # Number of generator steps taken, which paces the training histogram loss. global_step also counts the
+        # discriminator steps.
+        self._num_gen_steps = 0
         self.val_histo_loss = HistogramLoss(
             data_val, int(round(2.0 * math.pow(data_val.shape[0], 1.0 / 3.0), 0))
         )
@@ -152,6 +258,7 @@ class DiffPCFGANTrainer(Trainer):
         # Don't reverse, handled inside. The order should be start with original data and finishes with noise.
         # Shape (S,N,L,D).
         teacher_forcing_inputs=None,
+        time_steps: typing.Optional[torch.Tensor] = None,
     ) -> torch.Tensor:
         # Alias for forward for clarity
         return self(
@@ -161,6 +268,7 @@ class DiffPCFGANTrainer(Trainer):
             noise_start_seq_z=noise_start_seq_z,
             proba_teacher_forcing=proba_teacher_forcing,
             teacher_forcing_inputs=teacher_forcing_inputs,
+            time_steps=time_steps,
         )
 
     def forward(
@@ -172,8 +280,10 @@ class DiffPCFGANTrainer(Trainer):
         noise_start_seq_z: typing.Optional[torch.Tensor] = None,
         proba_teacher_forcing: float = 0.0,
         teacher_forcing_inputs=None,
+        time_steps: typing.Optional[torch.Tensor] = None,
     ) -> torch.Tensor:
         # Denoise data to generate new samples.
+        # time_steps are the time steps where the backward steps start, by default all of them. See backward_sample.
         # Along the first dimension, the first value corresponds to the output data (generated samples).
         assert (
             num_seq is not None and seq_len is not None and dim_seq is not None
@@ -190,138 +300,160 @@ class DiffPCFGANTrainer(Trainer):
             self.score_network,
             proba_teacher_forcing=proba_teacher_forcing,
             sequences_forcing=teacher_forcing_inputs,
+            reverse=True,
+            time_steps=time_steps,
         )
 
         # Returns a tensor with shape (num_step_diffusion, num_seq, seq_len, generator.outputdim).
         # Along the first dimension, the first value corresponds to the output data (generated samples).
-        return traj_back.flip(0)
+        return traj_back
 
     def configure_optimizers(self):
-        optim_gen = torch.optim.Adam(
+        optim_gen = make_adam(
             self.score_network.parameters(),
             lr=self.lr_gen,
             weight_decay=0,
-            betas=(0, 0.9),
+            betas=(0.0, 0.9),
         )
-        optim_discr = torch.optim.Adam(
+        optim_discr = make_adam(
             self.discriminator.parameters(), lr=self.lr_disc, weight_decay=0
         )
         return [optim_gen, optim_discr], []
 
+    def on_train_start(self) -> None:
+        # Warm-up forward and backward passes on a batch of the largest size, so the caching allocator reserves the
+        # blocks of the largest activations once, and the following smaller batches (e.g. the last one) reuse them.
+        # No optimiser step is taken, the gradients are discarded.
+        if self.warmup_max_batch is None or self.device.type != "cuda":
+            return
+
+        optim_gen, optim_discr = self.optimizers()
+        # The passes are on the unwrapped module, outside of the forward of DDP, so its reducer must neither expect
+        # them nor synchronise their gradients.
+        model = self.trainer.model
+        no_sync = (
+            model.no_sync
+            if isinstance(model, DistributedDataParallel)
+            else contextlib.nullcontext
+        )
+        # The random state is restored afterwards, so the training is the same with or without warm-up.
+        with torch.random.fork_rng(devices=[self.device]), no_sync():
+            targets = torch.randn(
+                (self.warmup_max_batch, self.config.n_lags, self.config.input_dim),
+                device=self.device,
+            )
+            total_loss, _, _ = self._compute_losses_gen(targets)
+            total_loss.backward()
+            self._compute_loss_disc(*self._sample_disc_inputs(targets)).backward()
+
+        optim_gen.zero_grad(set_to_none=True)
+        optim_discr.zero_grad(set_to_none=True)
+        torch.cuda.synchronize(self.device)
+        return
+
     def training_step(self, batch, batch_nb):
         (targets,) = batch
         optim_gen, optim_discr = self.optimizers()
 
         logger.debug("Targets for training: %s", targets)
-        losses_as_dict = self._training_step_gen(optim_gen, targets)
-
-        if not self.use_fixed_measure_discriminator_pcfd:
-            for i in range(self.D_steps_per_G_step):
-                _ = self._training_step_disc(optim_discr, targets)
-
+        losses_as_dict = self._training_step_gen(optim_gen, optim_discr, targets)
         # Discriminator and Generator share the same loss so no need to report both.
-        self.log(
-            name="train_pcfd",
-            value=losses_as_dict["train_pcfd"],
-            prog_bar=True,
-            on_step=False,
-            on_epoch=True,
-        )
-        self.log(
-            name="train_reconst",
-            value=losses_as_dict["train_reconst"],
+        # Single call for all the losses, detached so no reference to the graph is kept by the logger.
+        # The compiled distance is cloned when computed, so the discriminator steps cannot overwrite it with CUDA graphs.
+        self.log_dict(
+            {name: loss.detach() for name, loss in losses_as_dict.items()},
             prog_bar=True,
             on_step=False,
             on_epoch=True,
+            # Averaged over the processes with DDP, at the end of the epoch.
+            sync_dist=True,
         )
 
-        self.log(
-            name="train_score_matching",
-            value=losses_as_dict["train_score_matching"],
-            prog_bar=True,
-            on_step=False,
-            on_epoch=True,
-        )
-
-        self.log(
-            name="train_epdf",
-            value=losses_as_dict["train_epdf"],
-            prog_bar=True,
-            on_step=False,
-            on_epoch=True,
-        )
+        if not self.use_fixed_measure_discriminator_pcfd and self.D_steps_per_G_step:
+            # The first discriminator step is on the trajectories of the generator step, its gradients are already
+            # known from the generator backward. The following ones are on fresh trajectories, sampled once since the
+            # score network is not updated during the discriminator steps.
+            self._training_step_disc_from_gen_grads(optim_discr)
+            if self.D_steps_per_G_step > 1:
+                disc_inputs = self._sample_disc_inputs(targets)
+                for _ in range(self.D_steps_per_G_step - 1):
+                    _ = self._training_step_disc(optim_discr, *disc_inputs)
 
         return
 
     def validation_step(self, batch, batch_nb):
         (targets,) = batch
 
-        logger.debug("Targets for validation: %s", targets)
-        diffused_targets: torch.Tensor = self._get_forward_path(targets, [])
-        denoised_diffused_targets: torch.Tensor = self.get_backward_path(
-            noise_start_seq_z=diffused_targets[-1],
-            proba_teacher_forcing=0.0,
+        # With DDP, only the first process plots, on its shard of the validation data.
+        plot_this_epoch = (
+            not (self.current_epoch + 1) % PERIOD_PLOT_VAL
+            and self.trainer.is_global_zero
         )
 
-        diffused_targets = DiffPCFGANTrainer._flat_add_time_transpose_and_add_zero(
-            diffused_targets
-        )
-        denoised_diffused_targets = (
-            DiffPCFGANTrainer._flat_add_time_transpose_and_add_zero(
-                denoised_diffused_targets
+        # Nothing is backpropagated during validation.
+        with torch.inference_mode():
+            logger.debug("Targets for validation: %s", targets)
+            diffused_targets: torch.Tensor = self._get_forward_path(targets, [])
+            denoised_diffused_targets: torch.Tensor = self.get_backward_path(
+                noise_start_seq_z=diffused_targets[-1],
+                proba_teacher_forcing=0.0,
             )
-        )
-        logger.debug(
-            "\nDiffused targets for validation: \n%s\nDenoised samples for validation: %s\n",
-            diffused_targets,
-            denoised_diffused_targets,
-        )
-
-        loss_gen = self.discriminator.distance_measure(
-            diffused_targets[:, :-1][:, :NUM_STEPS_DIFFUSION_2_CONSIDER],
-            denoised_diffused_targets[:, :-1][:, :NUM_STEPS_DIFFUSION_2_CONSIDER],
-            lambda_y=0.0,
-        )
-        self.log(
-            name="val_pcfd",
-            value=loss_gen,
-            prog_bar=True,
-            on_step=False,
-            on_epoch=True,
-        )
 
-        loss_gen_reconst = self.reconstruction_loss(
-            diffused_targets[:, 1, :-1], denoised_diffused_targets[:, 1, :-1]
-        )
-        self.log(
-            name="val_reconst",
-            value=loss_gen_reconst,
-            prog_bar=True,
-            on_step=False,
-            on_epoch=True,
-        )
+            reconst_diffused_targets = self._reconstruction_view(diffused_targets)
+            reconst_denoised_targets = self._reconstruction_view(
+                denoised_diffused_targets
+            )
+            # Only the first steps are compared, the whole trajectories are only needed for the plots.
+            max_steps = None if plot_this_epoch else self.num_steps_diffusion_2_consider
+            diffused_targets = self._flat_add_time_transpose_and_add_zero(
+                diffused_targets, max_steps
+            )
+            denoised_diffused_targets = self._flat_add_time_transpose_and_add_zero(
+                denoised_diffused_targets, max_steps
+            )
+            logger.debug(
+                "\nDiffused targets for validation: \n%s\nDenoised samples for validation: %s\n",
+                diffused_targets,
+                denoised_diffused_targets,
+            )
 
-        loss_gen_score_matching = self._compute_score_matching_loss(targets)
-        self.log(
-            name="val_score_matching",
-            value=loss_gen_score_matching,
-            prog_bar=True,
-            on_step=False,
-            on_epoch=True,
-        )
+            loss_gen = self.discriminator.distance_measure(
+                diffused_targets[:, : self.num_steps_diffusion_2_consider],
+                denoised_diffused_targets[:, : self.num_steps_diffusion_2_consider],
+                lambda_y=0.0,
+            )
 
-        loss_gen_epdf = self.val_histo_loss(denoised_diffused_targets[:, 1:2, :-1])
-        self.log(
-            name="val_epdf",
-            value=loss_gen_epdf,
+            loss_gen_reconst = self.reconstruction_loss(
+                reconst_diffused_targets, reconst_denoised_targets
+            )
+            loss_gen_score_matching = self._compute_score_matching_loss(targets)
+            loss_gen_epdf = self.val_histo_loss(reconst_denoised_targets.unsqueeze(1))
+
+        # Logged outside of inference mode: with DDP, the logged values are synchronised in place at the end of the epoch.
+        self.log_dict(
+            {
+                "val_pcfd": loss_gen.detach(),
+                "val_reconst": loss_gen_reconst.detach(),
+                "val_score_matching": loss_gen_score_matching.detach(),
+                "val_epdf": loss_gen_epdf.detach(),
+            },
             prog_bar=True,
             on_step=False,
             on_epoch=True,
+            sync_dist=True,
         )
 
         # TODO 11/08/2024 nie_k: A bit of a hack, I usually code this better but will do the trick for now.
         # TODO 29/08/2024 nie_k: The plot need to be change depending on dataset (manually) and also would not work for sequences
-        if not (self.current_epoch + 1) % PERIOD_PLOT_VAL:
+        if plot_this_epoch:
+            # The copies of the trajectories to the host overlap with the plot of the histograms.
+            self._host_buffers_plots = tuple(
+                to_host_non_blocking(trajectories, buffer)
+                for trajectories, buffer in zip(
+                    (denoised_diffused_targets, diffused_targets),
+                    self._host_buffers_plots,
+                )
+            )
             where_image_is_saved = (
                 self.output_dir_images
                 + f"pred_vs_true_epoch_{str(self.current_epoch + 1)}"
@@ -332,144 +464,203 @@ class DiffPCFGANTrainer(Trainer):
                 where_image_is_saved,
             )
 
-            self.plot_for_back_ward_trajectories(
-                denoised_diffused_targets, diffused_targets
-            )
+            self.plot_for_back_ward_trajectories(*self._host_buffers_plots)
         return
 
+    @plt.rc_context(_SEABORN_THEME_RC)
     def plot_for_back_ward_trajectories(
         self, denoised_diffused_targets, diffused_targets
     ):
+        if self.device.type == "cuda":
+            # Wait for the copies to the host started without blocking.
+            torch.cuda.current_stream(self.device).synchronize()
         denoised_diffused_targets = denoised_diffused_targets.detach().cpu().numpy()
         diffused_targets = diffused_targets.detach().cpu().numpy()
 
-        PLOT_DIFFUSION_AXES[0].clear()
-        PLOT_DIFFUSION_AXES[1].clear()
+        # Created for each plot and closed once saved, so no figure is kept by the processes that never plot.
+        fig, axes = plt.subplots(1, 2, sharey=True)
 
         # Shift by one because we added a trailing zero to the sequences.
         diffusion_steps = np.arange(-1, denoised_diffused_targets.shape[1] - 1)
-
-        for element_dataset in range(diffused_targets.shape[0]):
-            PLOT_DIFFUSION_AXES[0].plot(
-                diffusion_steps,
-                diffused_targets[element_dataset, :, 0],
-                linewidth=1.0,
+        reversed_diffusion_steps = diffusion_steps[::-1]
+
+        # One collection per axis instead of one line per element, colored as successive calls to plot would be.
+        colors_cycle = plt.rcParams["axes.prop_cycle"].by_key()["color"]
+        axes[0].add_collection(
+            LineCollection(
+                self._trajectories_to_segments(diffusion_steps, diffused_targets),
+                linewidths=1.0,
+                colors=colors_cycle,
             )
-        PLOT_DIFFUSION_AXES[0].set_title("Forward Path")
-        PLOT_DIFFUSION_AXES[0].set_xlabel("Diffusion Step")
-        for element_dataset in range(denoised_diffused_targets.shape[0]):
-            PLOT_DIFFUSION_AXES[1].plot(
-                diffusion_steps[::-1],
-                denoised_diffused_targets[element_dataset, :, 0],
-                linewidth=1.0,
+        )
+        # Explicit limits, the collection does not update the data limits of the axis like plot does.
+        axes[0].set_xlim(diffusion_steps[0], diffusion_steps[-1])
+        axes[0].set_title("Forward Path")
+        axes[0].set_xlabel("Diffusion Step")
+        axes[1].add_collection(
+            LineCollection(
+                self._trajectories_to_segments(
+                    reversed_diffusion_steps, denoised_diffused_targets
+                ),
+                linewidths=1.0,
+                colors=colors_cycle,
             )
+        )
+        axes[1].set_xlim(diffusion_steps[0], diffusion_steps[-1])
+        # The y-axis is shared.
+        axes[1].set_ylim(
+            min(
+                diffused_targets[:, :, 0].min(),
+                denoised_diffused_targets[:, :, 0].min(),
+            ),
+            max(
+                diffused_targets[:, :, 0].max(),
+                denoised_diffused_targets[:, :, 0].max(),
+            ),
+        )
         # Reverse the x-ticks and labels
         # WIP: might lead to too many ticks. See how to handle that.
-        PLOT_DIFFUSION_AXES[0].set_xticks(diffusion_steps)
-        PLOT_DIFFUSION_AXES[0].set_xticklabels(diffusion_steps)
-        PLOT_DIFFUSION_AXES[1].set_xticks(diffusion_steps[::-1])
-        PLOT_DIFFUSION_AXES[1].set_xticklabels(diffusion_steps)
-        PLOT_DIFFUSION_AXES[1].set_title("Backward Path")
-        PLOT_DIFFUSION_AXES[1].set_xlabel("Diffusion Step")
-        PLOT_DIFFUSION_FIG.suptitle(
+        axes[0].set_xticks(diffusion_steps)
+        axes[0].set_xticklabels(diffusion_steps)
+        axes[1].set_xticks(reversed_diffusion_steps)
+        axes[1].set_xticklabels(diffusion_steps)
+        axes[1].set_title("Backward Path")
+        axes[1].set_xlabel("Diffusion Step")
+        fig.suptitle(
             f"Comparison Diffusion Trajectories for n={diffused_targets.shape[0]}. \nThe distribution are matched over the first {NUM_STEPS_DIFFUSION_2_CONSIDER} steps."
         )
-        PLOT_DIFFUSION_FIG.tight_layout()
+        fig.tight_layout()
         savefig(
-            PLOT_DIFFUSION_FIG,
+            fig,
             self.output_dir_images + f"trajectories_{str(self.current_epoch + 1)}.png",
         )
+        plt.close(fig)
         return
 
+    @staticmethod
+    def _trajectories_to_segments(
+        steps: np.ndarray, trajectories: np.ndarray
+    ) -> np.ndarray:
+        # Shape (N, S, 2): for each element, the points (step, first feature) of its trajectory.
+        return np.stack(
+            (
+                np.broadcast_to(steps, trajectories.shape[:2]),
+                trajectories[:, :, 0],
+            ),
+            axis=-1,
+        )
+
     @property
-    def proba_teacher_forcing(self):
+    def proba_teacher_forcing(self) -> float:
+        # Pure scalar math, kept as a Python float to avoid creating a tensor at every call.
         return 0.5 * (
-            1
-            + torch.cos(
-                torch.tensor(
-                    self.current_epoch * math.pi / (self.trainer.max_epochs // 2)
-                )
-            )
+            1.0
+            + math.cos(self.current_epoch * math.pi / (self.trainer.max_epochs // 2))
         )
 
     def _training_step_gen(
-        self, optim_gen, targets: torch.Tensor
+        self, optim_gen, optim_discr, targets: torch.Tensor
     ) -> typing.Dict[str, float]:
-        optim_gen.zero_grad()
-
-        diffused_targets: torch.Tensor = self._get_forward_path(targets, [])
-        denoised_diffused_targets: torch.Tensor = self.get_backward_path(
-            noise_start_seq_z=diffused_targets[-1],
-            proba_teacher_forcing=self.proba_teacher_forcing,
-            teacher_forcing_inputs=diffused_targets,
-        )
-        # TODO 06/09/2024 nie_k: If we add a zero, we can remove the last value! Let's see how we handle this.
-        diffused_targets = DiffPCFGANTrainer._flat_add_time_transpose_and_add_zero(
-            diffused_targets
-        )
-        denoised_diffused_targets = (
-            DiffPCFGANTrainer._flat_add_time_transpose_and_add_zero(
-                denoised_diffused_targets
-            )
-        )
-        logger.debug(
-            "\nDiffused targets for training: \n%s\nDenoised samples for training: %s\n",
-            diffused_targets,
-            denoised_diffused_targets,
-        )
-
-        loss_gen = self.discriminator.distance_measure(
-            diffused_targets[:, :-1][:, :NUM_STEPS_DIFFUSION_2_CONSIDER],
-            denoised_diffused_targets[:, :-1][:, :NUM_STEPS_DIFFUSION_2_CONSIDER],
-            lambda_y=0.0,
-        )
-        loss_gen_reconstruction = self.reconstruction_loss(
-            diffused_targets[:, 1, :-1], denoised_diffused_targets[:, 1, :-1]
-        )
-
-        total_loss = loss_gen + 0.1 * loss_gen_reconstruction
-
-        loss_gen_score_matching = self._compute_score_matching_loss(targets)
-        if self.use_diffusion_score_matching_loss:
-            total_loss = total_loss + 0.1 * loss_gen_score_matching
+        optim_gen.zero_grad(set_to_none=True)
+        # The gradients of the discriminator left by the backward are the ones of the PCF distance only,
+        # used by _training_step_disc_from_gen_grads.
+        optim_discr.zero_grad(set_to_none=True)
 
+        total_loss, losses, reconst_denoised_targets = self._compute_losses_gen(targets)
         self.manual_backward(total_loss)
         optim_gen.step()
 
-        loss_gen_epdf = self.train_histo_loss(denoised_diffused_targets[:, 1:2, :-1])
-        return {
-            "train_pcfd": loss_gen,
-            "train_reconst": loss_gen_reconstruction,
-            "train_score_matching": loss_gen_score_matching,
-            "train_epdf": loss_gen_epdf,
-        }
-
-    def _training_step_disc(
-        self, optim_discr, targets: torch.Tensor
-    ) -> typing.Dict[str, float]:
-        optim_discr.zero_grad()
-
-        with torch.no_grad():
+        # The histogram loss does not contribute to the gradient, so it is kept off most of the training steps. It is
+        # only reported on the steps where it is computed, its epoch value is the mean over them.
+        if not self._num_gen_steps % PERIOD_TRAIN_EPDF:
+            with torch.no_grad():
+                # Kept in fp32, the bins are too fine for bf16.
+                losses["train_epdf"] = self.train_histo_loss(
+                    reconst_denoised_targets.unsqueeze(1).float()
+                )
+        self._num_gen_steps += 1
+        return losses
+
+    def _compute_losses_gen(
+        self, targets: torch.Tensor
+    ) -> typing.Tuple[torch.Tensor, typing.Dict[str, torch.Tensor], torch.Tensor]:
+        # Returns the loss to backpropagate, the losses to report and the (flattened) generated samples.
+        # The backward is done outside of autocast, the gradients are in the dtype of the parameters.
+        with self._autocast():
             diffused_targets: torch.Tensor = self._get_forward_path(targets, [])
             denoised_diffused_targets: torch.Tensor = self.get_backward_path(
                 noise_start_seq_z=diffused_targets[-1],
                 proba_teacher_forcing=self.proba_teacher_forcing,
                 teacher_forcing_inputs=diffused_targets,
+                time_steps=self._training_backward_time_steps,
             )
-            diffused_targets = DiffPCFGANTrainer._flat_add_time_transpose_and_add_zero(
-                diffused_targets
+            reconst_diffused_targets = self._reconstruction_view(diffused_targets)
+            reconst_denoised_targets = self._reconstruction_view(
+                denoised_diffused_targets
             )
-            denoised_diffused_targets = (
-                DiffPCFGANTrainer._flat_add_time_transpose_and_add_zero(
-                    denoised_diffused_targets
-                )
+            # TODO 06/09/2024 nie_k: If we add a zero, we can remove the last value! Let's see how we handle this.
+            # Only the steps compared by the PCF distance are transformed.
+            diffused_targets = self._flat_add_time_transpose_and_add_zero(
+                diffused_targets, self.num_steps_diffusion_2_consider
+            )
+            denoised_diffused_targets = self._flat_add_time_transpose_and_add_zero(
+                denoised_diffused_targets, self.num_steps_diffusion_2_consider
+            )
+            logger.debug(
+                "\nDiffused targets for training: \n%s\nDenoised samples for training: %s\n",
+                diffused_targets,
+                denoised_diffused_targets,
             )
 
-        loss_disc = -self.discriminator.distance_measure(
-            diffused_targets[:, :-1][:, :NUM_STEPS_DIFFUSION_2_CONSIDER],
-            denoised_diffused_targets[:, :-1][:, :NUM_STEPS_DIFFUSION_2_CONSIDER],
-            lambda_y=0.0,
-        )
+            loss_gen = self.discriminator.distance_measure(
+                diffused_targets, denoised_diffused_targets, lambda_y=0.0
+            )
+            # In fp32, the residuals become small as the reconstruction improves. The PCF distance already casts its
+            # inputs to complex fp32 in the development layer.
+            loss_gen_reconstruction = self.reconstruction_loss(
+                reconst_diffused_targets.float(), reconst_denoised_targets.float()
+            )
+
+            total_loss = loss_gen + 0.1 * loss_gen_reconstruction
+
+            if self.use_diffusion_score_matching_loss:
+                loss_gen_score_matching = self._compute_score_matching_loss(targets)
+                total_loss = total_loss + 0.1 * loss_gen_score_matching
+            else:
+                # Only reported, so no graph is needed for it.
+                with torch.no_grad():
+                    loss_gen_score_matching = self._compute_score_matching_loss(targets)
+
+        return (
+            total_loss,
+            {
+                "train_pcfd": loss_gen,
+                "train_reconst": loss_gen_reconstruction,
+                "train_score_matching": loss_gen_score_matching,
+            },
+            reconst_denoised_targets,
+        )
+
+    def _training_step_disc_from_gen_grads(self, optim_discr) -> None:
+        # Discriminator step on the trajectories of the last generator step, without evaluating the PCF distance again.
+        # The discriminator loss is the opposite of the PCF loss of the generator, computed on the same samples and
+        # with the same discriminator, and no other term of the generator loss depends on the discriminator.
+        # Hence, its gradients are the opposite of the ones left on the discriminator by the generator backward.
+        for param in self.discriminator.parameters():
+            if param.grad is not None:
+                param.grad.neg_()
+        optim_discr.step()
+        return
+
+    def _training_step_disc(
+        self,
+        optim_discr,
+        diffused_targets: torch.Tensor,
+        denoised_diffused_targets: torch.Tensor,
+    ) -> typing.Dict[str, float]:
+        optim_discr.zero_grad(set_to_none=True)
+
+        loss_disc = self._compute_loss_disc(diffused_targets, denoised_diffused_targets)
         self.manual_backward(loss_disc)
         optim_discr.step()
 
@@ -477,6 +668,47 @@ class DiffPCFGANTrainer(Trainer):
             "train_pcfd": loss_disc,
         }
 
+    def _sample_disc_inputs(
+        self, targets: torch.Tensor
+    ) -> typing.Tuple[torch.Tensor, torch.Tensor]:
+        # Returns the transformed forward and backward trajectories compared by the discriminator, without graph.
+        # They only depend on the score network, so they can be reused by several discriminator steps.
+        with self._autocast():
+            with torch.inference_mode():
+                diffused_targets: torch.Tensor = self._get_forward_path(targets, [])
+                denoised_diffused_targets: torch.Tensor = self.get_backward_path(
+                    noise_start_seq_z=diffused_targets[-1],
+                    proba_teacher_forcing=self.proba_teacher_forcing,
+                    teacher_forcing_inputs=diffused_targets,
+                    time_steps=self._training_backward_time_steps,
+                )
+            # Inference tensors cannot be saved for the backward of the discriminator. The transformed trajectories
+            # are built outside of inference mode, hence are normal tensors, copied from the inference ones.
+            diffused_targets = self._flat_add_time_transpose_and_add_zero(
+                diffused_targets, self.num_steps_diffusion_2_consider
+            )
+            denoised_diffused_targets = self._flat_add_time_transpose_and_add_zero(
+                denoised_diffused_targets, self.num_steps_diffusion_2_consider
+            )
+        return diffused_targets, denoised_diffused_targets
+
+    def _compute_loss_disc(
+        self, diffused_targets: torch.Tensor, denoised_diffused_targets: torch.Tensor
+    ) -> torch.Tensor:
+        with self._autocast():
+            return -self.discriminator.distance_measure(
+                diffused_targets, denoised_diffused_targets, lambda_y=0.0
+            )
+
+    def _autocast(self) -> torch.autocast:
+        # bf16 autocast for the rollouts and the losses. bf16 has the exponent range of fp32, so no GradScaler needed.
+        # Only enabled on CUDA, where bf16 tensor cores are available.
+        return torch.autocast(
+            device_type=self.device.type,
+            dtype=torch.bfloat16,
+            enabled=self.use_bf16_autocast and self.device.type == "cuda",
+        )
+
     def _get_forward_path(
         self,
         starting_data: torch.Tensor,
@@ -489,40 +721,106 @@ class DiffPCFGANTrainer(Trainer):
             len(starting_data.shape) == 3
         ), f"Incorrect shape for starting_data: Expected 3 dimensions (N, L, D) but got {len(starting_data.shape)} dimensions with shape {starting_data.shape}. Make sure the tensor is correctly reshaped or initialized."
 
-        diffused_starting_data: torch.Tensor = (
-            starting_data.clone()
-            .unsqueeze(0)
-            .repeat(self.num_diffusion_steps + 1, 1, 1, 1)
+        # The trajectory is written into a buffer reused across the calls, instead of repeating the starting data
+        # along the diffusion axis only to overwrite most of it afterwards.
+        # The previous forward path is overwritten, it should not be needed anymore when this function is called.
+        diffused_starting_data: torch.Tensor = self._get_forward_path_buffer(
+            starting_data
         )
 
-        mask_where_diffuse = torch.ones(starting_data.shape[-1], dtype=torch.bool)
-        mask_where_diffuse[indices_features_not_diffuse] = False
-
-        diffused_starting_data[:, :, :, mask_where_diffuse] = (
+        indices_diffuse, indices_not_diffuse = self._get_indices_where_diffuse(
+            starting_data.shape[-1], indices_features_not_diffuse, starting_data.device
+        )
+        if indices_not_diffuse is None:
+            # All the features are diffused, the forward sample is written directly into the trajectory.
+            # Contiguous like the indexed copies below, randn_like follows the memory layout of its input.
             self.diffusion_process.forward_sample(
-                starting_data[:, :, mask_where_diffuse]
+                starting_data.contiguous(), out=diffused_starting_data
+            )
+        else:
+            # Index tensors rather than boolean masks, which require a synchronisation to find the selected features.
+            # The features which are not diffused are constant along the diffusion axis (broadcast over S).
+            diffused_starting_data[:, :, :, indices_not_diffuse] = starting_data[
+                :, :, indices_not_diffuse
+            ].unsqueeze(0)
+            diffused_starting_data[:, :, :, indices_diffuse] = (
+                self.diffusion_process.forward_sample(
+                    starting_data[:, :, indices_diffuse]
+                )
             )
-        )
 
         # Shape (S, N, L, D). This shape makes sense because we are interested in the tensor N,L,D by slices over S-dim.
         return diffused_starting_data
 
+    def _get_forward_path_buffer(self, starting_data: torch.Tensor) -> torch.Tensor:
+        # Returns a view of shape (S, N, L, D) of the buffer of the forward paths, sized for the largest batch seen.
+        N, L, D = starting_data.shape
+        buffer = self._forward_path_buffer
+        if (
+            buffer is None
+            or buffer.shape[1] < N
+            or buffer.shape[2:] != (L, D)
+            or buffer.dtype != starting_data.dtype
+            or buffer.device != starting_data.device
+        ):
+            # Never allocated as an inference tensor, which could not be written to outside of inference mode.
+            with torch.inference_mode(False):
+                buffer = torch.empty(
+                    (self.num_diffusion_steps + 1, N, L, D),
+                    device=starting_data.device,
+                    dtype=starting_data.dtype,
+                )
+            self._forward_path_buffer = buffer
+        return buffer[:, :N]
+
+    def _get_indices_where_diffuse(
+        self,
+        num_features: int,
+        indices_features_not_diffuse: typing.Iterable,
+        device: torch.device,
+    ) -> typing.Tuple[torch.Tensor, typing.Optional[torch.Tensor]]:
+        # Returns the indices of the features to diffuse and of the ones not to diffuse, None if all are diffused.
+        # They only depend on the arguments, so they are built once and stored on the device where they are used.
+        key = (num_features, tuple(indices_features_not_diffuse), device)
+        if key not in self._indices_where_diffuse:
+            mask_where_diffuse = torch.ones(num_features, dtype=torch.bool)
+            mask_where_diffuse[list(indices_features_not_diffuse)] = False
+            indices_diffuse = mask_where_diffuse.nonzero().squeeze(1).to(device)
+            indices_not_diffuse = (
+                None
+                if mask_where_diffuse.all()
+                else (~mask_where_diffuse).nonzero().squeeze(1).to(device)
+            )
+            self._indices_where_diffuse[key] = (indices_diffuse, indices_not_diffuse)
+        return self._indices_where_diffuse[key]
+
     def _compute_score_matching_loss(self, targets):
+        # One diffusion time per element of the batch, for a Monte-Carlo estimate over the times.
         time_step_diffusion = torch.randint(
-            1, self.num_diffusion_steps + 1, (1,), device=self.device
+            1, self.num_diffusion_steps + 1, (targets.shape[0],), device=self.device
         )
+        # Shape (N, 1, 1) to broadcast the coefficients over the sequence and feature dimensions.
+        time_step_diffusion_broadcast = time_step_diffusion.view(
+            -1, *([1] * (targets.dim() - 1))
+        )
+        # Only the diffusion coefficient is needed, so the drift is computed on a broadcastable zero
+        # instead of a zero tensor of the size of the targets.
         _, diffusion = self.diffusion_process._compute_drift_and_diffusion(
-            torch.zeros_like(targets), time_step_diffusion
+            torch.zeros_like(time_step_diffusion_broadcast, dtype=targets.dtype),
+            time_step_diffusion_broadcast,
         )
         mean, std = self.diffusion_process._perturbation_kernel(
-            targets, time_step_diffusion
+            targets, time_step_diffusion_broadcast
         )
         noise = torch.randn_like(targets)
-        perturbed_noise = mean + std * noise
+        # Fused mean + std * noise.
+        perturbed_noise = torch.addcmul(mean, std, noise)
         pred_score = self.score_network(perturbed_noise, time_step_diffusion)
         # NCSN score matching objective function (x_tilda - x) / sigma^2
-        target = -noise / std
+        # The quotient is a fresh tensor, so it can be negated in place.
+        target = noise.div(std).neg_()
+        # The weighting diffusion^2 differs per element, so it is applied before averaging.
         loss_gen_score_matching = (
-            diffusion * diffusion * self.reconstruction_loss(pred_score, target)
-        )
+            diffusion.square() * (pred_score - target).square()
+        ).mean()
         return loss_gen_score_matching
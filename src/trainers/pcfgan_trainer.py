@@ -2,7 +2,7 @@ import torch
 
 from src.PCF_with_empirical_measure import PCF_with_empirical_measure
 from src.trainers.trainer import Trainer
-from src.utils.utils import cat_linspace_times
+from src.utils.utils import cat_linspace_times, make_adam
 
 # TODO 12/08/2024 nie_k: Add a way to add a zero at the beginning of a sequence without having to sample it for Swissroll.
 # TODO 12/08/2024 nie_k: Alternative plot for swiss roll.
@@ -68,13 +68,13 @@ class PCFGANTrainer(Trainer):
         return out
 
     def configure_optimizers(self):
-        optim_gen = torch.optim.Adam(
+        optim_gen = make_adam(
             self.generator.parameters(),
             lr=self.lr_gen,
             weight_decay=0,
-            betas=(0, 0.9),
+            betas=(0.0, 0.9),
         )
-        optim_discr = torch.optim.Adam(
+        optim_discr = make_adam(
             self.discriminator.parameters(), lr=self.lr_disc, weight_decay=0
         )
         return [optim_gen, optim_discr], []
@@ -95,18 +95,21 @@ class PCFGANTrainer(Trainer):
             prog_bar=True,
             on_step=False,
             on_epoch=True,
+            sync_dist=True,
         )
         return
 
     def validation_step(self, batch, batch_nb):
         (targets,) = batch
-        fake_samples = self.augmented_forward(
-            num_seq=targets.shape[0],
-            seq_len=targets.shape[1],
-        )
-        loss_gen = self.discriminator.distance_measure(
-            targets, fake_samples, lambda_y=0.1
-        )
+        # Nothing is backpropagated during validation.
+        with torch.inference_mode():
+            fake_samples = self.augmented_forward(
+                num_seq=targets.shape[0],
+                seq_len=targets.shape[1],
+            )
+            loss_gen = self.discriminator.distance_measure(
+                targets, fake_samples, lambda_y=0.1
+            )
 
         self.log(
             name="val_pcfd",
@@ -114,10 +117,15 @@ class PCFGANTrainer(Trainer):
             prog_bar=True,
             on_step=False,
             on_epoch=True,
+            sync_dist=True,
         )
 
         # TODO 11/08/2024 nie_k: A bit of a hack, I usually code this better but will do the trick for now.
-        if not (self.current_epoch + 1) % PERIOD_PLOT_VAL:
+        # With DDP, only the first process plots.
+        if (
+            not (self.current_epoch + 1) % PERIOD_PLOT_VAL
+            and self.trainer.is_global_zero
+        ):
             path = (
                 self.output_dir_images
                 + f"pred_vs_true_epoch_{str(self.current_epoch + 1)}"
@@ -125,8 +133,8 @@ class PCFGANTrainer(Trainer):
             self.evaluate(fake_samples, targets, path)
         return
 
-    def _training_step_gen(self, optim_gen, targets: torch.Tensor) -> float:
-        optim_gen.zero_grad()
+    def _training_step_gen(self, optim_gen, targets: torch.Tensor) -> torch.Tensor:
+        optim_gen.zero_grad(set_to_none=True)
 
         fake_samples = self.augmented_forward(
             num_seq=targets.shape[0],
@@ -138,20 +146,23 @@ class PCFGANTrainer(Trainer):
 
         self.manual_backward(loss_gen)
         optim_gen.step()
-        return loss_gen.item()
+        # Detached tensor instead of .item(), the host sync is left to the logger at the end of the epoch.
+        return loss_gen.detach()
 
-    def _training_step_disc(self, optim_discr, targets: torch.Tensor) -> float:
-        optim_discr.zero_grad()
+    def _training_step_disc(self, optim_discr, targets: torch.Tensor) -> torch.Tensor:
+        optim_discr.zero_grad(set_to_none=True)
 
-        with torch.no_grad():
+        with torch.inference_mode():
             fake_samples = self.augmented_forward(
                 num_seq=targets.shape[0],
                 seq_len=targets.shape[1],
             )
+        # Inference tensors cannot be saved for the backward of the discriminator, the clone is a normal tensor.
+        fake_samples = fake_samples.clone()
         loss_disc = -self.discriminator.distance_measure(
             targets, fake_samples, lambda_y=0.1
         )
         self.manual_backward(loss_disc)
         optim_discr.step()
 
-        return loss_disc.item()
+        return loss_disc.detach()
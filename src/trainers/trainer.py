@@ -1,32 +1,111 @@
 import logging
+import os
+import sys
 import time
 import warnings
 from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
 
+import matplotlib
 import matplotlib.pyplot as plt
-import seaborn as sns
+import numpy as np
 import torch
+from matplotlib.figure import Figure
 from matplotlib.lines import Line2D
 from pytorch_lightning import LightningModule
+from scipy.stats import gaussian_kde
 
+from src.utils.utils import to_host_non_blocking
 from src.utils.utils_os import savefig
 
 logger = logging.getLogger(__name__)
 
+# Without a display, the plots are only saved to files, so the non-interactive backend is enough.
+if sys.platform.startswith("linux") and not os.environ.get("DISPLAY"):
+    matplotlib.use("Agg")
+
+# One legend entry for each type of sequences of plot_sample_seqs. The legends only copy the style of their handles, so
+# they are shared by all the plots.
+_SAMPLE_SEQS_LEGEND_HANDLES = [
+    Line2D([0], [0], color="r", marker="x", alpha=0.3, label="real"),
+    Line2D([0], [0], color="b", marker="x", alpha=0.3, label="fake"),
+]
+
+# The plotting method of evaluate is only questioned once per process.
+_WARNED = False
+
+# Worker thread drawing and saving the histograms while the training continues, see Trainer.plot_histograms. Shared by
+# all the trainers of the process and created at the first plot. Kept out of the modules so they stay picklable and
+# copyable, and so no thread is left behind by a fit that raises; its idle thread is joined at the exit of the process.
+_PLOT_EXECUTOR: Optional[ThreadPoolExecutor] = None
+
+
+def _plot_executor() -> ThreadPoolExecutor:
+    global _PLOT_EXECUTOR
+    if _PLOT_EXECUTOR is None:
+        _PLOT_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="plot")
+    return _PLOT_EXECUTOR
+
+
+def _check_plotted_samples(real_X: torch.Tensor, fake_X: torch.Tensor) -> None:
+    # Shape checks shared by the plotting methods.
+    assert (
+        real_X.shape[-1] == fake_X.shape[-1]
+    ), f"Data should have the same sizes, but got {real_X.shape[-1]} and {fake_X.shape[-1]}"
+    assert real_X.dim() == 2, f"Data should have 2 dimensions, but got {real_X.dim()}"
+    assert fake_X.dim() == 2, f"Data should have 2 dimensions, but got {fake_X.dim()}"
+
+
+@lru_cache(maxsize=8)
+def _plotted_indices(
+    num_samples: int, num_plotted: int, device: torch.device
+) -> torch.Tensor:
+    # The same random subset is plotted every time for the same number of samples, which spares a permutation per plot
+    # and keeps the plots of successive epochs comparable. Drawn from a generator of its own, so plotting does not
+    # change the random state of the training.
+    generator = torch.Generator().manual_seed(num_samples)
+    return torch.randperm(num_samples, generator=generator)[:num_plotted].to(device)
+
+
+def _to_host_numpy(tensor: torch.Tensor) -> np.ndarray:
+    # One copy through page-locked memory, waited for before being read.
+    host_tensor = to_host_non_blocking(tensor)
+    if tensor.is_cuda:
+        torch.cuda.current_stream(tensor.device).synchronize()
+    return host_tensor.numpy()
+
 
 class Trainer(LightningModule):
+    # Upper bound on the number of bins of the plotted histograms, so their cost does not grow with the samples.
+    MAX_BINS = 100
+    # Upper bound on the number of real sequences drawn by plot_sample_seqs.
+    MAX_PLOTTED_SEQUENCES = 200
+    # Upper bound on the number of real points drawn by plot_swiss_roll.
+    MAX_PLOTTED_POINTS = 2000
+    # Upper bound on the number of points of each sample the KDE of plot_histograms is fitted on.
+    MAX_KDE_POINTS = 10_000
+    # Size of the histories of losses_history when the number of epochs is not known.
+    DEFAULT_LOSSES_HISTORY_CAPACITY = 1024
+
     def __init__(
         self,
         test_metrics_train,
         test_metrics_test,
         feature_dim_time_series,
         foo=lambda x: x,
+        plot_every_n_epochs: int = 10,
     ):
         super().__init__()
 
         self.num_epochs = 1
 
-        self.losses_history = defaultdict(list)
+        # Histories appended by evaluate, see losses_history. Each one is kept in an array preallocated for the number of
+        # epochs of the fit (see on_fit_start), filled up to its size.
+        self._losses_history_buffers: Dict[str, np.ndarray] = {}
+        self._losses_history_sizes: Dict[str, int] = defaultdict(int)
+        self._losses_history_capacity = self.DEFAULT_LOSSES_HISTORY_CAPACITY
 
         self.test_metrics_train = test_metrics_train
         self.test_metrics_test = test_metrics_test
@@ -35,67 +114,198 @@ class Trainer(LightningModule):
         self.init_time = time.time()
 
         self.feature_dim_time_series = feature_dim_time_series
-        self.plot_samples = plt.subplots(1, 1)[0]
+        # evaluate only plots one epoch out of plot_every_n_epochs, and at the last epoch.
+        assert (
+            plot_every_n_epochs >= 1
+        ), f"plot_every_n_epochs should be at least 1 but got {plot_every_n_epochs}."
+        self.plot_every_n_epochs = plot_every_n_epochs
+        # Pending plot of the histograms, drawn and saved by the worker thread on a new figure per plot since pyplot
+        # is not thread-safe.
+        self._plot_future: Optional[Future] = None
+        return
+
+    def __getstate__(self) -> dict:
+        # The pending plot is neither pickled nor copied with the module.
+        state = super().__getstate__()
+        state["_plot_future"] = None
+        return state
+
+    @property
+    def losses_history(self) -> Dict[str, List[float]]:
+        # The recorded values of each history, in order.
+        return {
+            name: buffer[: self._losses_history_sizes[name]].tolist()
+            for name, buffer in self._losses_history_buffers.items()
+        }
+
+    def _append_losses_history(self, name: str, value: float) -> None:
+        buffer = self._losses_history_buffers.get(name)
+        size = self._losses_history_sizes[name]
+        if buffer is None or size == buffer.shape[0]:
+            # Grown by doubling if evaluate is called more often than planned, so no value is ever dropped.
+            new_buffer = np.empty(max(2 * size, self._losses_history_capacity))
+            if buffer is not None:
+                new_buffer[:size] = buffer
+            self._losses_history_buffers[name] = buffer = new_buffer
+        buffer[size] = value
+        self._losses_history_sizes[name] = size + 1
+        return
+
+    def on_fit_start(self) -> None:
+        # evaluate is usually called at most once per epoch, so the histories are preallocated for all of them at once.
+        if self.trainer.max_epochs is not None and self.trainer.max_epochs > 0:
+            self._losses_history_capacity = self.trainer.max_epochs
+        return
+
+    def teardown(self, stage: str) -> None:
+        # Waits for the last plot, and raises its errors if any.
+        if self._plot_future is not None:
+            plot_future, self._plot_future = self._plot_future, None
+            plot_future.result()
         return
 
     def evaluate(self, x_fake, x_real, path_file):
         # Better to pass x_fake and x_real with the same size such that the plots are comparable.
-        self.losses_history["time"].append(time.time() - self.init_time)
+        self._append_losses_history("time", time.time() - self.init_time)
+        epoch = self.current_epoch + 1
+        if epoch % self.plot_every_n_epochs and epoch != self.trainer.max_epochs:
+            return
 
-        for i in range(len(self.plot_samples.axes)):
-            self.plot_samples.axes[i].clear()
+        global _WARNED
+        if not _WARNED:
+            warnings.warn(
+                "\n~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~\n"
+                "Is it the correct plotting method? Otherwise it might be either ugly or fail."
+                "\n~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~"
+            )
+            _WARNED = True
+        # self.plot_swiss_roll(x_real, x_fake, plt.subplots(1, 1)[0], path_file)
+        self.plot_histograms(x_real, x_fake, path_file)
+        return
 
-        warnings.warn(
-            "\n~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~\n"
-            "Is it the correct plotting method? Otherwise it might be either ugly or fail."
-            "\n~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~"
+    def plot_histograms(self, real_X, fake_X, path_file: str):
+        _check_plotted_samples(real_X, fake_X)
+
+        real_values = real_X[:, 0].detach().float()
+        fake_values = fake_X[:, 0].detach().float()
+        # The histograms are computed where the data is, over the range of both samples.
+        all_values = torch.cat((real_values, fake_values))
+        low, high = torch.aminmax(all_values)
+        low, high = low.item(), high.item()
+        num_integers = int(high - low) + 1
+        if num_integers <= self.MAX_BINS and torch.equal(
+            all_values, all_values.round()
+        ):
+            # Integer values (e.g. time steps or labels) have one unit bin centred on each integer.
+            low, high = low - 0.5, high + 0.5
+            bins = num_integers
+        else:
+            if low == high:
+                # Unit width around constant values, as numpy does.
+                low, high = low - 0.5, high + 0.5
+            # The bins grow with the size of the smaller sample, up to a bounded number of patches to draw.
+            num_samples = min(real_values.shape[0], fake_values.shape[0])
+            bins = max(min(num_samples // 10, self.MAX_BINS), 1)
+        # Both samples share the same bins, so their bars are comparable.
+        densities = self._histogram_densities(
+            all_values, real_values.shape[0], low, high, bins
         )
-        # self.plot_swiss_roll(x_real, x_fake, self.plot_samples, path_file)
-        self.plot_histograms(x_real, x_fake, self.plot_samples, path_file)
-        return
 
-    @staticmethod
-    def plot_histograms(real_X, fake_X, fig, path_file: str):
-        assert (
-            real_X.shape[-1] == fake_X.shape[-1]
-        ), "Data should have the same sizes, but got {} and {}".format(
-            real_X.shape[-1], fake_X.shape[-1]
+        # The cost of the KDE grows with the number of points, a random subset of them is enough for its shape.
+        real_values = self._kde_values(real_values)
+        fake_values = self._kde_values(fake_values)
+
+        # Everything drawn is copied to the host at once.
+        densities, real_values, fake_values = np.split(
+            _to_host_numpy(torch.cat((densities.flatten(), real_values, fake_values))),
+            np.cumsum((2 * bins, real_values.shape[0])),
         )
-        assert (
-            len(real_X.shape) == 2
-        ), "Data should have 2 dimensions, but got {}".format(len(real_X.shape))
-        assert (
-            len(fake_X.shape) == 2
-        ), "Data should have 2 dimensions, but got {}".format(len(fake_X.shape))
-
-        sns.distplot(
-            real_X[:, 0].detach().cpu().numpy(),
-            kde=True,
-            color="blue",
-            label="Real Data",
-            hist=True,
-            ax=fig.axes[0],
-            bins=real_X[:, 0].shape[0] // 10,
+        if self._plot_future is not None:
+            # Raises the errors of the previous plot, if any.
+            self._plot_future.result()
+        self._plot_future = _plot_executor().submit(
+            self._draw_histograms,
+            densities.reshape(2, bins),
+            (real_values, fake_values),
+            (low, high),
+            (real_X.shape[0], fake_X.shape[0]),
+            path_file,
         )
+        return
 
-        sns.distplot(
-            fake_X[:, 0].detach().cpu().numpy(),
-            kde=True,
-            color="red",
-            label="Sampled Data",
-            hist=True,
-            ax=fig.axes[0],
-            bins=fake_X[:, 0].shape[0] // 10,
+    @staticmethod
+    def _kde_values(values: torch.Tensor) -> torch.Tensor:
+        # At most MAX_KDE_POINTS of the values, taken at random since the samples are not necessarily shuffled.
+        if values.shape[0] <= Trainer.MAX_KDE_POINTS:
+            return values
+        return values.index_select(
+            0, _plotted_indices(values.shape[0], Trainer.MAX_KDE_POINTS, values.device)
         )
-        fig.axes[0].set_title(
-            f"Histogram with KDE comparing true (n={real_X.shape[0]}) and generated (n={fake_X.shape[0]}) data"
+
+    @staticmethod
+    def _draw_histograms(
+        densities: np.ndarray,
+        values: Tuple[np.ndarray, np.ndarray],
+        value_range: Tuple[float, float],
+        num_samples: Tuple[int, int],
+        path_file: str,
+    ):
+        # Only uses a figure not managed by pyplot, so it can run in a worker thread.
+        fig = Figure()
+        ax = fig.subplots(1, 1)
+        for densities_sample, values_sample, color, label in zip(
+            densities, values, ("blue", "red"), ("Real Data", "Sampled Data")
+        ):
+            Trainer._plot_histogram_with_kde(
+                ax, densities_sample, values_sample, value_range, color, label
+            )
+        ax.set_title(
+            f"Histogram with KDE comparing true (n={num_samples[0]}) and generated (n={num_samples[1]}) data"
         )
-        fig.axes[0].set_xlabel("Value")
-        fig.axes[0].set_ylabel("Density")
-        fig.axes[0].legend()
+        ax.set_xlabel("Value")
+        ax.set_ylabel("Density")
+        ax.legend()
 
         savefig(fig, path_file)
-        plt.pause(0.01)
+        return
+
+    @staticmethod
+    def _histogram_densities(
+        values: torch.Tensor, num_real: int, low: float, high: float, bins: int
+    ) -> torch.Tensor:
+        # Densities of the histograms of the real values followed by the fake ones, with the same bins of equal width
+        # over [low, high]. Both are counted in a single pass, the bins of the fake values following the real ones.
+        indices = ((values - low) * (bins / (high - low))).long().clamp_(0, bins - 1)
+        indices[num_real:] += bins
+        counts = torch.bincount(indices, minlength=2 * bins).view(2, bins)
+        return counts * (bins / (high - low)) / counts.sum(dim=1, keepdim=True)
+
+    @staticmethod
+    def _plot_histogram_with_kde(
+        ax,
+        densities: np.ndarray,
+        values: np.ndarray,
+        value_range: Tuple[float, float],
+        color,
+        label,
+    ):
+        # Density histogram and its Gaussian KDE evaluated on a small grid, as seaborn's deprecated distplot draws.
+        low, high = value_range
+        bins = densities.shape[0]
+        ax.bar(
+            np.linspace(low, high, bins + 1)[:-1],
+            densities,
+            width=(high - low) / bins,
+            align="edge",
+            color=color,
+            alpha=0.4,
+            label=label,
+        )
+
+        # The KDE is undefined for constant values.
+        if values.min() < values.max():
+            grid = np.linspace(values.min(), values.max(), 200)
+            ax.plot(grid, gaussian_kde(values)(grid), color=color)
         return
 
     @staticmethod
@@ -103,49 +313,45 @@ class Trainer(LightningModule):
         # path file should change if you save multiple times, extension preferably a png.
         # Convention followed is that last axis' last dimension represents time, used for the x-axis.
         # PLots other lines (along second axis for each dimension of the last axis).
-        assert (
-            real_X.shape[-1] == fake_X.shape[-1]
-        ), "Data should have the same sizes, but got {} and {}".format(
-            real_X.shape[-1], fake_X.shape[-1]
-        )
-        assert (
-            len(real_X.shape) == 2
-        ), "Data should have 2 dimensions, but got {}".format(len(real_X.shape))
-        assert (
-            len(fake_X.shape) == 2
-        ), "Data should have 2 dimensions, but got {}".format(len(fake_X.shape))
+        _check_plotted_samples(real_X, fake_X)
         assert len(fig.axes) == real_X.shape[-1] - 1, (
             "Number of subplots should be equal to the number of dimensions of the last axis of the data minus 1, "
             "but got {} and {}"
         ).format(len(fig.axes), real_X.shape[-1] - 1)
 
-        random_indices = torch.randint(real_X.shape[0], (real_X.shape[0],))
+        # Without replacement, so no sequence is drawn twice.
+        random_indices = _plotted_indices(
+            real_X.shape[0], Trainer.MAX_PLOTTED_SEQUENCES, real_X.device
+        )
+        # Both samples are gathered and copied to the host at once, with the sequence axis first as plot expects.
+        real_X, fake_X = np.split(
+            _to_host_numpy(
+                torch.cat((real_X.index_select(0, random_indices), fake_X))
+                .transpose(0, 1)
+                .contiguous()
+            ),
+            (random_indices.shape[0],),
+            axis=1,
+        )
         for i in range(real_X.shape[-1] - 1):
             fig.axes[i].plot(
-                real_X[random_indices, :, 1].detach().cpu().numpy().T,
-                real_X[random_indices, :, 0].detach().cpu().numpy().T,
+                real_X[:, :, 1],
+                real_X[:, :, 0],
                 "r-x",
                 alpha=0.3,
             )
 
             fig.axes[i].plot(
-                fake_X[:, :, 1].detach().cpu().numpy().T,
-                fake_X[:, :, 0].detach().cpu().numpy().T,
+                fake_X[:, :, 1],
+                fake_X[:, :, 0],
                 "b-x",
                 alpha=0.3,
             )
 
             # Add only one legend entry for each type
-
-            custom_lines = [
-                Line2D([0], [0], color="r", marker="x", alpha=0.3, label="real"),
-                Line2D([0], [0], color="b", marker="x", alpha=0.3, label="fake"),
-            ]
-
-            fig.axes[i].legend(handles=custom_lines)
+            fig.axes[i].legend(handles=_SAMPLE_SEQS_LEGEND_HANDLES)
 
         savefig(fig, path_file)
-        plt.pause(0.01)
         return
 
     @staticmethod
@@ -153,19 +359,12 @@ class Trainer(LightningModule):
         # path file should change if you save multiple times, extension preferably a png.
         # Convention followed is that last axis' last dimension represents time, used for the x-axis.
         # PLots other lines (along second axis for each dimension of the last axis).
-        assert (
-            real_X.shape[-1] == fake_X.shape[-1]
-        ), "Data should have the same sizes, but got {} and {}".format(
-            real_X.shape[-1], fake_X.shape[-1]
-        )
-        assert (
-            len(real_X.shape) == 2
-        ), "Data should have 2 dimensions, but got {}".format(len(real_X.shape))
-        assert (
-            len(fake_X.shape) == 2
-        ), "Data should have 2 dimensions, but got {}".format(len(fake_X.shape))
+        _check_plotted_samples(real_X, fake_X)
 
-        random_indices = torch.randint(real_X.shape[0], (real_X.shape[0],))
+        # Without replacement, so no point is drawn twice.
+        random_indices = _plotted_indices(
+            real_X.shape[0], Trainer.MAX_PLOTTED_POINTS, real_X.device
+        )
 
         # Only supporting 2D
         if real_X.shape[-1] != 2:
@@ -178,18 +377,22 @@ class Trainer(LightningModule):
                 RuntimeWarning,
             )
 
+        # Both samples are copied to the host at once.
+        real_X, fake_X = np.split(
+            _to_host_numpy(torch.cat((real_X.index_select(0, random_indices), fake_X))),
+            (random_indices.shape[0],),
+        )
         plt.scatter(
-            real_X[random_indices, 0].detach().cpu().numpy().T,
-            real_X[random_indices, 1].detach().cpu().numpy().T,
+            real_X[:, 0].T,
+            real_X[:, 1].T,
             alpha=0.5,
         )
         plt.scatter(
-            fake_X[:, 0].detach().cpu().numpy().T,
-            fake_X[:, 1].detach().cpu().numpy().T,
+            fake_X[:, 0].T,
+            fake_X[:, 1].T,
             marker="1",
             alpha=0.5,
         )
         plt.legend(["Original data", "Generated data"])
         savefig(fig, path_file)
-        plt.pause(0.01)
         return
@@ -17,19 +17,37 @@ class FastTensorDataLoader:
         https://github.com/hcarlens/pytorch-tabular/blob/master/fast_tensor_data_loader.py
     """
 
-    def __init__(self, *tensors, batch_size=32, shuffle=False):
+    def __init__(
+        self, *tensors, batch_size=32, shuffle=False, num_replicas=1, rank=0, seed=0
+    ):
         """
         Initialize a FastTensorDataLoader.
         :param *tensors: tensors to store. Must have the same length @ dim 0.
-        :param batch_size: batch size to load.
+        :param batch_size: batch size to load, per process.
         :param shuffle: if True, shuffle the data *in-place* whenever an
             iterator is created out of this object.
+        :param num_replicas: number of processes of the distributed training.
+            Lightning cannot add a DistributedSampler to this loader, so each
+            process only keeps its shard of the data, as the sampler would.
+        :param rank: rank of the current process, between 0 and num_replicas - 1.
+        :param seed: seed of the shuffling when num_replicas > 1, which must
+            give the same permutation on all the processes.
         :returns: A FastTensorDataLoader.
         """
         assert all(t.shape[0] == tensors[0].shape[0] for t in tensors), "wrong shapes."
-        self.tensors = tensors
-
-        self.dataset_len = self.tensors[0].shape[0]
+        assert (
+            0 <= rank < num_replicas
+        ), f"Expected a rank in [0, {num_replicas}) but got {rank}."
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        # The whole data is kept such that shuffling happens before sharding.
+        self.all_tensors = tensors
+        # Same number of elements on all the processes, otherwise the number of batches could differ and the
+        # processes would wait for each other. At most num_replicas - 1 elements are dropped.
+        self.dataset_len = self.all_tensors[0].shape[0] // num_replicas
+        self.tensors = self._shard(tensors)
         self.batch_size = batch_size
         self.shuffle = shuffle
 
@@ -39,10 +57,25 @@ class FastTensorDataLoader:
             n_batches += 1
         self.n_batches = n_batches
 
+    def _shard(self, tensors):
+        if self.num_replicas == 1:
+            return tensors
+        return [
+            t[self.rank : self.dataset_len * self.num_replicas : self.num_replicas]
+            for t in tensors
+        ]
+
     def __iter__(self):
         if self.shuffle:
-            r = torch.randperm(self.dataset_len)
-            self.tensors = [t[r] for t in self.tensors]
+            if self.num_replicas == 1:
+                r = torch.randperm(self.dataset_len)
+                self.tensors = [t[r] for t in self.tensors]
+            else:
+                # Same permutation on all the processes, changing at every epoch, then sharded.
+                generator = torch.Generator().manual_seed(self.seed + self.epoch)
+                self.epoch += 1
+                r = torch.randperm(self.all_tensors[0].shape[0], generator=generator)
+                self.tensors = self._shard([t[r] for t in self.all_tensors])
         self.i = 0
         return self
 
@@ -1,4 +1,6 @@
+import inspect
 import pickle
+import typing
 
 import torch
 import torch.nn as nn
@@ -17,6 +19,53 @@ def save_obj(obj: object, filepath: str):
     return 0
 
 
+def to_host_non_blocking(
+    tensor: torch.Tensor, out: typing.Optional[torch.Tensor] = None
+) -> torch.Tensor:
+    """
+    Starts the copy of a tensor to the host without blocking, through page-locked memory when the tensor is on CUDA.
+    The result must only be read once the current CUDA stream is synchronised.
+
+    Args:
+        tensor: The tensor to copy.
+        out: Optional pinned host buffer of the same shape and dtype to reuse. Allocated if None or not matching.
+
+    Returns:
+        The host tensor receiving the copy. Tensors already on the host are returned detached, without copy.
+    """
+    if not tensor.is_cuda:
+        return tensor.detach()
+    if out is None or out.shape != tensor.shape or out.dtype != tensor.dtype:
+        out = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+    out.copy_(tensor.detach(), non_blocking=True)
+    return out
+
+
+def make_adam(parameters: typing.Iterable[torch.Tensor], **kwargs) -> torch.optim.Adam:
+    """
+    Builds an Adam optimiser updating all the parameters in a few kernels rather than a few per parameter.
+
+    Args:
+        parameters: The parameters to optimise.
+        kwargs: The other arguments of Adam.
+
+    Returns:
+        Adam with a single fused kernel when the parameters are real floating point tensors on CUDA, which the fused
+        implementation requires (e.g. not the complex ones of the PCF). Otherwise with the batched foreach updates.
+        Each option is only passed when the installed torch supports it (foreach since 1.12, fused since 2.0).
+    """
+    parameters = list(parameters)
+    supported_options = inspect.signature(torch.optim.Adam).parameters
+    use_fused = "fused" in supported_options and all(
+        param.is_cuda and torch.is_floating_point(param) for param in parameters
+    )
+    if use_fused:
+        return torch.optim.Adam(parameters, fused=True, **kwargs)
+    if "foreach" in supported_options:
+        return torch.optim.Adam(parameters, foreach=True, **kwargs)
+    return torch.optim.Adam(parameters, **kwargs)
+
+
 def init_weights(m):
     if isinstance(m, nn.Linear):
         nn.init.xavier_uniform_(m.weight.data, gain=nn.init.calculate_gain("relu"))
@@ -70,12 +119,11 @@ def cat_linspace_times(values_time_series):
     ), f"Input shape must be [size, length, dim] but got {values_time_series.shape}"
 
     N, L, D = values_time_series.shape
-    tt = (
-        torch.linspace(0.0, 1, L, device=values_time_series.device)
-        .view(1, -1, 1)
-        .repeat(N, 1, 1)
-    )
-    return torch.cat([values_time_series, tt], dim=-1)
+    # Filled in place rather than with repeat and cat, which allocate and copy the data twice.
+    out = values_time_series.new_empty((N, L, D + 1))
+    out[..., :D] = values_time_series
+    out[..., D] = torch.linspace(0.0, 1, L, device=values_time_series.device)
+    return out
 
 
 # TODO 28/08/2024 nie_k: UNUSED
@@ -86,9 +134,7 @@ def cat_linspace_times_4D(values_time_series):
     ), f"Input shape must be [Diffusion steps, size, length, dim] but got {values_time_series.shape}"
 
     S, N, L, D = values_time_series.shape
-    tt = (
-        torch.linspace(0.0, 1.0, L, device=values_time_series.device)
-        .view(1, 1, -1, 1)
-        .expand(S, N, L, 1)
-    )
-    return torch.cat([values_time_series, tt], dim=-1)
+    out = values_time_series.new_empty((S, N, L, D + 1))
+    out[..., :D] = values_time_series
+    out[..., D] = torch.linspace(0.0, 1.0, L, device=values_time_series.device)
+    return out
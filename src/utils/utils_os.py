@@ -116,5 +116,10 @@ def savefig(fig: plt.Figure, path_file: str) -> None:
     """
     directory_where_to_save = os.path.dirname(path_file)
     makedir(directory_where_to_save)
-    fig.savefig(path_file)
+    extension = os.path.splitext(path_file)[1].lower()
+    if extension in ("", ".png"):
+        # The lowest zlib level encodes several times faster for slightly bigger files.
+        fig.savefig(path_file, pil_kwargs={"compress_level": 1})
+    else:
+        fig.savefig(path_file)
     return
@@ -43,14 +43,29 @@ class SwissRoll_Dataset(LightningDataModule):
         self.val_in = self.inputs[training_size:]
         return
 
+    def _distributed_kwargs(self):
+        # With DDP, each process loads its own shard of the data.
+        if self.trainer is None:
+            return {}
+        return {
+            "num_replicas": self.trainer.world_size,
+            "rank": self.trainer.global_rank,
+        }
+
     def train_dataloader(self):
-        return FastTensorDataLoader(self.train_in, batch_size=self.batch_size)
+        return FastTensorDataLoader(
+            self.train_in, batch_size=self.batch_size, **self._distributed_kwargs()
+        )
 
     def val_dataloader(self):
-        return FastTensorDataLoader(self.val_in, batch_size=self.batch_size)
+        return FastTensorDataLoader(
+            self.val_in, batch_size=self.batch_size, **self._distributed_kwargs()
+        )
 
     def test_dataloader(self):
-        return FastTensorDataLoader(self.inputs, batch_size=self.batch_size)
+        return FastTensorDataLoader(
+            self.inputs, batch_size=self.batch_size, **self._distributed_kwargs()
+        )
 
     def plot_data(self):
         import matplotlib.pyplot as plt
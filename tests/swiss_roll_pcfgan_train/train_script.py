@@ -8,12 +8,20 @@ It erases the folder before running the script.
 """
 
 import logging
+import os
 import time
 
 import numpy as np
 import seaborn as sns
+import torch
 from matplotlib import pyplot as plt
 
+# The trajectories are large and their sizes vary (batch size, steps between training and validation), which fragments
+# the blocks of the CUDA caching allocator. Expandable segments (torch>=2.1) grow the blocks instead. Read at the first
+# CUDA allocation, and left to the environment if already set, e.g. to disable it when sharing memory through CUDA IPC.
+if hasattr(torch.cuda.memory, "_set_allocator_settings"):
+    os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
+
 from src.logger.init_logger import set_config_logging
 
 set_config_logging()
@@ -63,6 +71,23 @@ config = {
     # WIP NUM ELEMENT IN SEQ?
     "n_lags": data.inputs.shape[1],
     "exp_dir": datamodel_path,
+    # Compile the score network and the discriminator with torch.compile (requires torch>=2.2). The compiled functions
+    # are specialised to the shapes of the batches, each new batch size (e.g. a smaller last batch, or the validation
+    # batches) is compiled, and with "reduce-overhead" recorded as CUDA graphs, once on its first call.
+    "compile_model": False,
+    # Mode of torch.compile for the score network and the discriminator, "max-autotune" for benchmarking.
+    "compile_mode": "reduce-overhead",
+    # bf16 autocast of the rollouts and the losses, only effective on CUDA. Faster, but changes the numerics of the
+    # generator and of the PCF losses compared to fp32.
+    "use_bf16_autocast": False,
+    # Size of the largest batch, for a warm-up pass preallocating the CUDA memory. None to skip it.
+    "warmup_max_batch": min(data.batch_size, data.train_in.shape[0]),
+    # Stride of the noisy backward steps during training, which are not compared. 1 samples every step.
+    "backward_stride_training": 1,
+    # The histograms of evaluate are only plotted one epoch out of plot_every_n_epochs, and at the last epoch.
+    "plot_every_n_epochs": 10,
+    # Train with DistributedDataParallel on all the GPUs, a single GPU otherwise.
+    "use_ddp": False,
 }
 config = Config(config)
 
@@ -104,7 +129,10 @@ epochs = 5001
 trainer = Trainer(
     default_root_dir=path2file_linker(["out"]),
     # gradient_clip_val=0.1,
-    gpus=1,
+    # With use_ddp, one process per GPU. DDP keeps find_unused_parameters=True by default, which is needed because the
+    # generator and the discriminator steps each only reach part of the parameters.
+    gpus=-1 if config.use_ddp else 1,
+    strategy="ddp" if config.use_ddp else None,
     max_epochs=epochs,
     logger=[logger_custom],
     check_val_every_n_epoch=period_log,
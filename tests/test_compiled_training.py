@@ -0,0 +1,73 @@
+import tempfile
+import unittest
+
+import torch
+from pytorch_lightning import Trainer, seed_everything
+
+from src.networks.models.toynet import ToyNet
+from src.trainers.diffpcfgan_trainer import DiffPCFGANTrainer
+from tests.swiss_roll_pcfgan_train.swissroll_dataset import SwissRoll_Dataset
+
+
+class Config:
+    """Adapter to convert a dictionary to an object with properties/fields."""
+
+    def __init__(self, config_dict):
+        for key, value in config_dict.items():
+            setattr(self, key, value)
+
+
+def fit(exp_dir: str, accelerator: str, compile_mode: str):
+    seed_everything(142)
+    data = SwissRoll_Dataset(200, True)
+    # Several batches with a smaller last one, which the compiled functions see as new shapes.
+    data.batch_size = 64
+    config = Config(
+        {
+            "input_dim": data.inputs.shape[2],
+            "n_lags": data.inputs.shape[1],
+            "exp_dir": exp_dir,
+            "compile_model": True,
+            "compile_mode": compile_mode,
+        }
+    )
+    model = DiffPCFGANTrainer(
+        data_train=data.train_in,
+        data_val=data.val_in,
+        score_network=ToyNet(data_dim=config.input_dim),
+        config=config,
+        learning_rate_gen=1e-3,
+        learning_rate_disc=1e-3,
+        num_D_steps_per_G_step=2,
+        num_samples_pcf=4,
+        hidden_dim_pcf=4,
+        num_diffusion_steps=8,
+    )
+    trainer = Trainer(
+        max_epochs=2,
+        accelerator=accelerator,
+        devices=1,
+        logger=False,
+        enable_checkpointing=False,
+        enable_progress_bar=False,
+        enable_model_summary=False,
+        num_sanity_val_steps=0,
+    )
+    trainer.fit(model, datamodule=data)
+    return trainer.callback_metrics
+
+
+@unittest.skipUnless(torch.cuda.is_available(), "CUDA graphs require a GPU.")
+class TestCompiledTraining(unittest.TestCase):
+    def test_reduce_overhead(self):
+        # With CUDA graphs, the training and the validation read the losses after further compiled calls, which raises
+        # if their outputs were overwritten by the graphs of these calls.
+        with tempfile.TemporaryDirectory() as exp_dir:
+            metrics = fit(exp_dir + "/", "gpu", "reduce-overhead")
+        for name in ("train_pcfd", "train_score_matching", "val_pcfd", "val_epdf"):
+            with self.subTest(name=name):
+                self.assertTrue(torch.isfinite(metrics[name]).item())
+
+
+if __name__ == "__main__":
+    unittest.main()
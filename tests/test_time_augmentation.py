@@ -0,0 +1,104 @@
+import types
+import unittest
+
+import torch
+
+from src.trainers.diffpcfgan_trainer import DiffPCFGANTrainer
+from src.utils.utils import cat_linspace_times, cat_linspace_times_4D
+
+
+# Constructions with torch.cat that the preallocated layouts replaced.
+def reference_cat_linspace_times(values_time_series):
+    N, L, D = values_time_series.shape
+    tt = (
+        torch.linspace(0.0, 1, L, device=values_time_series.device)
+        .view(1, -1, 1)
+        .repeat(N, 1, 1)
+    )
+    return torch.cat([values_time_series, tt], dim=-1)
+
+
+def reference_cat_linspace_times_4D(values_time_series):
+    S, N, L, D = values_time_series.shape
+    tt = (
+        torch.linspace(0.0, 1.0, L, device=values_time_series.device)
+        .view(1, 1, -1, 1)
+        .expand(S, N, L, 1)
+    )
+    return torch.cat([values_time_series, tt], dim=-1)
+
+
+def reference_flat_add_time_transpose_and_add_zero(data):
+    data = data.flatten(2, 3)
+    zeros = torch.zeros(1, data.shape[1], data.shape[2], device=data.device)
+    data = torch.cat((zeros, data), dim=0)
+    diffusion_times = (
+        torch.linspace(0.0, 1.0, steps=data.shape[0], device=data.device)
+        .view(-1, 1, 1)
+        .expand(data.shape[0], data.shape[1], 1)
+    )
+    data = torch.cat((data, diffusion_times), dim=-1)
+    return data.transpose(0, 1)
+
+
+class TestTimeAugmentation(unittest.TestCase):
+    # Number of diffusion steps of the trainer, the trajectories have one more step for the initial state.
+    NUM_DIFFUSION_STEPS = 7
+
+    def setUp(self):
+        torch.manual_seed(0)
+        # Only the cached times are read by _flat_add_time_transpose_and_add_zero.
+        self.trainer = types.SimpleNamespace(
+            _diffusion_times=torch.linspace(
+                0.0, 1.0, steps=self.NUM_DIFFUSION_STEPS + 2
+            )
+        )
+
+    def flat_add_time_transpose_and_add_zero(self, data, max_steps=None):
+        return DiffPCFGANTrainer._flat_add_time_transpose_and_add_zero(
+            self.trainer, data, max_steps
+        )
+
+    def test_cat_linspace_times(self):
+        values = torch.randn(5, 4, 3, requires_grad=True)
+        result = cat_linspace_times(values)
+        torch.testing.assert_close(
+            result, reference_cat_linspace_times(values), rtol=0, atol=0
+        )
+        # The gradients flow through the assignment of the values.
+        result.sum().backward()
+        torch.testing.assert_close(values.grad, torch.ones_like(values))
+
+    def test_cat_linspace_times_4D(self):
+        values = torch.randn(6, 5, 4, 3)
+        torch.testing.assert_close(
+            cat_linspace_times_4D(values),
+            reference_cat_linspace_times_4D(values),
+            rtol=0,
+            atol=0,
+        )
+
+    def test_flat_add_time_transpose_and_add_zero(self):
+        data = torch.randn(self.NUM_DIFFUSION_STEPS + 1, 5, 4, 3)
+        torch.testing.assert_close(
+            self.flat_add_time_transpose_and_add_zero(data),
+            reference_flat_add_time_transpose_and_add_zero(data),
+            rtol=0,
+            atol=0,
+        )
+
+    def test_flat_add_time_transpose_and_add_zero_max_steps(self):
+        data = torch.randn(self.NUM_DIFFUSION_STEPS + 1, 5, 4, 3)
+        # The first max_steps steps of the whole transformed trajectory, the zero at the beginning included.
+        for max_steps in (1, 2, self.NUM_DIFFUSION_STEPS + 2):
+            with self.subTest(max_steps=max_steps):
+                torch.testing.assert_close(
+                    self.flat_add_time_transpose_and_add_zero(data, max_steps),
+                    reference_flat_add_time_transpose_and_add_zero(data)[:, :max_steps],
+                    rtol=0,
+                    atol=0,
+                )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,6 +3,8 @@ import torch
 
 from sklearn.datasets import make_swiss_roll
 
+device = "cuda"
+
 x, _ = make_swiss_roll(n_samples=100_000, noise=0.5)
 
 # TODO 10/08/2024 nie_k:  change that for 3D, change plots.
@@ -10,7 +12,7 @@ x, _ = make_swiss_roll(n_samples=100_000, noise=0.5)
 x = x[:, [0, 2]]
 
 x = (x - x.mean()) / x.std()
-X = torch.tensor(x, dtype=torch.float32)
+X = torch.tensor(x, dtype=torch.float32, device=device)
 
 plt.figure()
 plt.title("Swiss roll dataset")
@@ -22,7 +24,8 @@ diffusion_steps = 40  # Number of steps in the diffusion process
 
 # Set noising variances betas as in Nichol and Dariwal paper (https://arxiv.org/pdf/2102.09672.pdf)
 s = 0.008
-timesteps = torch.tensor(range(0, diffusion_steps), dtype=torch.float32)
+# The schedule is computed once on the device of the data, so noising does not involve host transfers.
+timesteps = torch.arange(diffusion_steps, dtype=torch.float32, device=device)
 schedule = torch.cos((timesteps / diffusion_steps + s) / (1 + s) * torch.pi / 2) ** 2
 
 baralphas = schedule / schedule[0]
@@ -31,7 +34,7 @@ alphas = 1 - betas
 
 # Check the cumulative alphas follow the distribution recommended in the paper
 plt.figure()
-plt.plot(baralphas)
+plt.plot(baralphas.cpu())
 plt.title("Cumulative alphas")
 plt.xlabel("Diffusion step")
 plt.ylabel(r"$\bar{\alpha}$")
@@ -39,19 +42,19 @@ plt.pause(0.5)
 
 
 def noise(Xbatch, t):
-    eps = torch.randn(size=Xbatch.shape)
-    noised = (baralphas[t] ** 0.5).repeat(1, Xbatch.shape[1]) * Xbatch + (
-        (1 - baralphas[t]) ** 0.5
-    ).repeat(1, Xbatch.shape[1]) * eps
+    eps = torch.randn(Xbatch.shape, device=Xbatch.device, dtype=Xbatch.dtype)
+    # baralphas[t] has shape (N, 1) and broadcasts over the features.
+    noised = baralphas[t].sqrt() * Xbatch + (1 - baralphas[t]).sqrt() * eps
     return noised, eps
 
 
 noiselevel = 20
 
-noised, eps = noise(X, torch.full([len(X), 1], fill_value=noiselevel))
+noised, eps = noise(X, torch.full([len(X), 1], fill_value=noiselevel, device=device))
+noised = noised.cpu()
 plt.figure()
 plt.scatter(noised[:, 0], noised[:, 1], marker="*", alpha=0.5)
-plt.scatter(X[:, 0], X[:, 1], alpha=0.5)
+plt.scatter(x[:, 0], x[:, 1], alpha=0.5)
 plt.legend(["Noised data", "Original data"])
 plt.pause(0.5)
 
@@ -88,7 +91,6 @@ class DiffusionModel(nn.Module):
 
 model = DiffusionModel(nfeatures=2, nblocks=4)
 
-device = "cuda"
 model = model.to(device)
 
 import torch.optim as optim
@@ -106,10 +108,12 @@ for epoch in range(1):
     epoch_loss = steps = 0
     for i in range(0, len(X), batch_size):
         Xbatch = X[i : i + batch_size]
-        timesteps = torch.randint(0, diffusion_steps, size=[len(Xbatch), 1])
+        timesteps = torch.randint(
+            0, diffusion_steps, size=[len(Xbatch), 1], device=device
+        )
         noised, eps = noise(Xbatch, timesteps)
-        predicted_noise = model(noised.to(device), timesteps.to(device))
-        loss = loss_fn(predicted_noise, eps.to(device))
+        predicted_noise = model(noised, timesteps)
+        loss = loss_fn(predicted_noise, eps)
         optimizer.zero_grad()
         loss.backward()
         optimizer.step()
@@ -121,10 +125,10 @@ for epoch in range(1):
 def sample_ddpm(model, nsamples, nfeatures):
     """Sampler following the Denoising Diffusion Probabilistic Models method by Ho et al (Algorithm 2)"""
     with torch.no_grad():
-        x = torch.randn(size=(nsamples, nfeatures)).to(device)
+        x = torch.randn(size=(nsamples, nfeatures), device=device)
         xt = [x]
         for t in range(diffusion_steps - 1, 0, -1):
-            predicted_noise = model(x, torch.full([nsamples, 1], t).to(device))
+            predicted_noise = model(x, torch.full([nsamples, 1], t, device=device))
             # See DDPM paper between equations 11 and 12
             x = (
                 1
@@ -136,7 +140,7 @@ def sample_ddpm(model, nsamples, nfeatures):
                 # Choosing the variance through beta_t is optimal for x_0 a normal distribution
                 variance = betas[t]
                 std = variance ** (0.5)
-                x += std * torch.randn(size=(nsamples, nfeatures)).to(device)
+                x += std * torch.randn(size=(nsamples, nfeatures), device=device)
             xt += [x]
         return x, xt
 
@@ -144,7 +148,7 @@ def sample_ddpm(model, nsamples, nfeatures):
 Xgen, Xgen_hist = sample_ddpm(model, 10000, 2)
 Xgen = Xgen.cpu()
 plt.figure()
-plt.scatter(X[:, 0], X[:, 1], alpha=0.5)
+plt.scatter(x[:, 0], x[:, 1], alpha=0.5)
 plt.scatter(Xgen[:, 0], Xgen[:, 1], marker="1", alpha=0.5)
 plt.legend(["Original data", "Generated data"])
 plt.show()